@@ -7,11 +7,14 @@ setup(
     scripts=[
 		'bin/sparqueue-api',
 		'bin/sparqueue-cli',
+		'bin/sparqueue-migrate',
+		'bin/sparqueue-reaper',
 		'bin/sparqueue-worker'
 	],
     data_files=[('config', [
             'config/worker.json',
             'config/api.json',
+            'config/reaper.json',
             'config/sparqueue-cli.json'
         ])
     ],
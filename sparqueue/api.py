@@ -1,19 +1,37 @@
 from __future__ import absolute_import
 
-from bottle import route, run, request, post, get, response, delete
+from bottle import route, run, request, post, get, response, delete, abort
+from bottle import default_app
 
 import json
+import os
 import sys
 import redis
+import threading
 import time
 
+import sparqueue.archive
+import sparqueue.incoming
 import sparqueue.queue
 import sparqueue.redis
+import sparqueue.server
 import sparqueue.config
 import sparqueue.logging
 
 logger = sparqueue.logging.getLogger(__file__)
 
+# longest a wait request may block, in seconds
+MAX_WAIT = 300
+
+# concurrent event streams, the requests over it get a 503, see execute
+EVENT_STREAMS = threading.BoundedSemaphore(1)
+# concurrent blocking waits, the waits over it return right away
+WAITS = threading.BoundedSemaphore(1)
+# Redis client of the event streams and waits, apart from the shared pool
+BLOCKING_REDIS = None
+# seconds an event stream is kept open
+EVENTS_DURATION = 300
+
 
 @post('/<system>/queues/<queue>/jobs')
 def queues_submit(system, queue):
@@ -31,20 +49,116 @@ def queues_submit(system, queue):
     return queue_instance.push(job)
 
 
+@post('/<system>/queues/<queue>/jobs/batch')
+def queues_submit_batch(system, queue):
+    # newline-delimited JSON jobs, the jobids are streamed back one per line;
+    # every job is checked first so that a bad line submits none of them
+    queue_instance = MANAGER.get(system, queue)
+    jobs = read_jobs(request.body)
+    for (number, job) in enumerate(jobs, 1):
+        try:
+            queue_instance.validate(job)
+        except sparqueue.queue.QueueException, e:
+            abort(400, 'Invalid job %s: %s' % (number, e))
+    response.headers['Content-Type'] = 'text/plain'
+    jobids = queue_instance.push_many(jobs)
+    return ('%s\n' % jobid for jobid in jobids)
+
+
+@post('/<system>/queues/<queue>/jobs/status')
+def queues_status_many(system, queue):
+    # JSON array of jobids, the statuses are returned in the same order
+    queue_instance = MANAGER.get(system, queue)
+    response.headers['Content-Type'] = 'text/json'
+    return json.dumps(queue_instance.status_many(read_jobids(request.body)))
+
+
+@post('/<system>/queues/<queue>/jobs/fetch')
+def queues_job_many(system, queue):
+    queue_instance = MANAGER.get(system, queue)
+    response.headers['Content-Type'] = 'text/json'
+    return json_array(queue_instance.jobs_many(read_jobids(request.body)))
+
+
+@post('/<system>/queues/<queue>/jobs/cancel')
+def queues_cancel_many(system, queue):
+    queue_instance = MANAGER.get(system, queue)
+    response.headers['Content-Type'] = 'text/json'
+    return json.dumps(queue_instance.cancel_many(read_jobids(request.body)))
+
+
+def read_jobids(body):
+    try:
+        jobids = json.load(body)
+    except ValueError:
+        abort(400, 'Invalid JSON array of jobids')
+    if (not isinstance(jobids, list) or
+            not all(isinstance(jobid, basestring) for jobid in jobids)):
+        abort(400, 'Invalid JSON array of jobids')
+    return [str(jobid) for jobid in jobids]
+
+
+def json_array(objs):
+    # streams a JSON array one element at a time
+    yield '['
+    separator = ''
+    for obj in objs:
+        yield separator + json.dumps(obj)
+        separator = ','
+    yield ']'
+
+
+def read_jobs(lines):
+    jobs = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            jobs.append(json.loads(line))
+        except ValueError, e:
+            logger.error('Error loading: %s' % line)
+            abort(400, 'Invalid JSON job %s: %s' % (len(jobs) + 1, e))
+    return jobs
+
+
 @get('/<system>/queues/<queue>/jobs')
 def queues_list(system, queue):
     queue_instance = MANAGER.get(system, queue)
     response.headers['Content-Type'] = 'text/json'
-    l = queue_instance.list()
-    return json.dumps(l)
+    status = request.query.get('status', 'EVERY')
+    if status not in sparqueue.queue.LIST_STATUS:
+        abort(400, 'Invalid status: %s' % status)
+    limit = request.query.get('limit')
+    if limit:
+        # a single page, the cursor for the next one is in the headers
+        (cursor, jobs) = queue_instance.scan(
+            status, request.query.get('cursor', 0), limit)
+        response.headers['X-Sparqueue-Cursor'] = str(cursor)
+        return json_array(jobs)
+    return json_array(queue_instance.iterate(status))
+
+
+@get('/<system>/queues/<queue>/stats')
+def queues_stats(system, queue):
+    queue_instance = MANAGER.get(system, queue)
+    response.headers['Content-Type'] = 'text/json'
+    return json.dumps(queue_instance.stats())
 
 
 @get('/<system>/queues/<queue>/workers')
 def workers_list(system, queue):
+    # status filters the workers, rollup adds their counts per status and
+    # per host
     queue_instance = MANAGER.get(system, queue)
     response.headers['Content-Type'] = 'text/json'
-    l = queue_instance.workers()
-    return json.dumps(l)
+    status = request.query.get('status')
+    if status and status not in sparqueue.queue.WORKER_STATUS:
+        abort(400, 'Invalid status: %s' % status)
+    registry = queue_instance.worker_registry(status)
+    if request.query.get('rollup'):
+        return json.dumps(registry)
+    return json.dumps(registry['workers'])
 
 
 @delete('/<system>/queues/<queue>/workers/<workerid>')
@@ -75,6 +189,71 @@ def queues_state(system, queue, jobid):
     return queue_instance.status(jobid)
 
 
+@get('/<system>/events')
+def events_stream(system):
+    # Server-Sent Events of the job state changes of system, optionally
+    # of a single queue or job
+    queue = request.query.get('queue')
+    jobid = request.query.get('jobid')
+    if queue:
+        channels = [MANAGER.get(system, queue).events_channel]
+    elif system in MANAGER.queues:
+        channels = [q.events_channel for q in MANAGER.queues[system].values()]
+    else:
+        abort(404, 'Invalid system: %s' % system)
+    if not EVENT_STREAMS.acquire(False):
+        abort(503, 'Too many event streams')
+    try:
+        pubsub = BLOCKING_REDIS.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(*channels)
+    except Exception:
+        EVENT_STREAMS.release()
+        raise
+    response.headers['Content-Type'] = 'text/event-stream'
+    response.headers['Cache-Control'] = 'no-cache'
+    return event_stream(pubsub, jobid, duration=EVENTS_DURATION)
+
+
+def event_stream(pubsub, jobid=None, keepalive=15, duration=300):
+    # ends after duration seconds, EventSource clients reconnect by
+    # themselves; releases its EVENT_STREAMS slot once closed
+    end = time.time() + duration
+    try:
+        yield ': connected\n\n'
+        while time.time() < end:
+            message = pubsub.get_message(
+                timeout=max(0, min(keepalive, end - time.time())))
+            if message is None:
+                # comment line so proxies and clients keep the connection
+                yield ': keepalive\n\n'
+                continue
+            if jobid and json.loads(message['data'])['jobid'] != jobid:
+                continue
+            yield 'data: %s\n\n' % message['data']
+    finally:
+        pubsub.close()
+        EVENT_STREAMS.release()
+
+
+@get('/<system>/queues/<queue>/jobs/<jobid>/wait')
+def queues_wait(system, queue, jobid):
+    # long poll returning once the job is finished or after timeout seconds
+    queue_instance = MANAGER.get(system, queue)
+    response.headers['Content-Type'] = 'text/json'
+    try:
+        timeout = float(request.query.get('timeout', 30))
+    except ValueError:
+        abort(400, 'Invalid timeout: %s' % request.query.get('timeout'))
+    if not WAITS.acquire(False):
+        # as many waits as allowed are blocking, the current status only
+        return queue_instance.wait(jobid, 0)
+    try:
+        return queue_instance.wait(
+            jobid, min(timeout, MAX_WAIT), BLOCKING_REDIS)
+    finally:
+        WAITS.release()
+
+
 def loop(config_filename):
     while True:
         config = sparqueue.config.get_config(config_filename)
@@ -88,11 +267,68 @@ def loop(config_filename):
 
 
 def execute(config):
-    global MANAGER
+    global MANAGER, EVENT_STREAMS, WAITS, BLOCKING_REDIS, EVENTS_DURATION
 
-    redisclient = sparqueue.redis.client(config)
+    threads = config.get('threads', 32)
+    # the pool also serves the background threads
+    redisclient = sparqueue.redis.client(
+        config, config.get('redis_connections', threads + 8),
+        config.get('redis_pool_timeout', 5))
+
+    server = config.get('server', 'threads')
+    if server == 'threads':
+        # streams and waits hold a request thread, some are kept for the
+        # others
+        max_event_streams = config.get('max_event_streams', threads // 4)
+        max_waits = config.get('max_waits', threads // 2)
+    else:
+        # a single-threaded server would block on the first one
+        max_event_streams = config.get('max_event_streams', 0)
+        max_waits = config.get('max_waits', 0)
+    EVENT_STREAMS = threading.BoundedSemaphore(max_event_streams)
+    WAITS = threading.BoundedSemaphore(max_waits)
+    # they don't wait for a connection of the shared pool
+    BLOCKING_REDIS = sparqueue.redis.client(
+        config, max(max_event_streams + max_waits, 1))
+    EVENTS_DURATION = config.get('event_stream_duration', 300)
 
     MANAGER = sparqueue.queue.QueueManager(config, redisclient)
     MANAGER.add_list(config['queues'])
 
-    run(host=config['host'], port=config['port'], debug=config['debug'])
+    if 'archive_dir' in config:
+        setup_archives(config)
+
+    if 'incoming' in config:
+        incoming = sparqueue.incoming.Incoming(
+            MANAGER, config['incoming'], config.get('incoming_batch', 500),
+            ttl=config.get('incoming_ttl', 86400))
+        incoming.start()
+
+    options = config.get('server_options', {})
+    if server == 'threads':
+        server = sparqueue.server.ThreadPoolServer
+        options = {
+            'threads': threads,
+            'backlog': config.get('backlog', 128),
+            'request_timeout': config.get('request_timeout', 30),
+            'keepalive_timeout': config.get('keepalive_timeout', 5)}
+    app = default_app()
+    if config.get('gzip', True):
+        app = sparqueue.server.GzipMiddleware(app)
+    run(app=app, host=config['host'], port=config['port'],
+        debug=config['debug'], server=server, **options)
+
+
+def setup_archives(config):
+    # one archive per system, shared by its queues
+    archives = {}
+    for q in config['queues']:
+        system = q['system']
+        if system not in archives:
+            archives[system] = sparqueue.archive.Archive(
+                os.path.join(config['archive_dir'], system))
+        MANAGER.get(system, q['queue']).archive = archives[system]
+
+    archiver = sparqueue.archive.Archiver(
+        MANAGER, config['queues'], config.get('archive_interval', 60))
+    archiver.start()
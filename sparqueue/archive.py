@@ -0,0 +1,160 @@
+from __future__ import absolute_import
+
+import anydbm
+import json
+import os
+import struct
+import threading
+import time
+import traceback
+import zlib
+
+import sparqueue.logging
+import sparqueue.reaper
+
+logger = sparqueue.logging.getLogger(__file__)
+
+# each record is its length followed by the zlib compressed JSON job
+RECORD_HEADER = struct.Struct('>I')
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+class Archive():
+    # append-only segment files of finished jobs with an on-disk index of
+    # jobid => segment, offset, length; one process appends at a time (see
+    # Archiver) and the index is reopened to see its changes, at most every
+    # refresh_interval seconds for the lookups
+    def __init__(self, directory, segment_size=SEGMENT_SIZE,
+                 refresh_interval=5):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+        self.index_filename = os.path.join(directory, 'index')
+        # read-only index and when it was opened
+        self.index = None
+        self.opened = 0
+
+    def append(self, jobs):
+        # jobs is a list of (jobid, config), the index is synced once the
+        # records are on disk
+        with self.lock:
+            index = anydbm.open(self.index_filename, 'c')
+            segment = self._last_segment()
+            writer = open(self._segment_filename(segment), 'ab')
+            try:
+                writer.seek(0, os.SEEK_END)
+                for (jobid, config) in jobs:
+                    if writer.tell() >= self.segment_size:
+                        writer.close()
+                        segment = segment + 1
+                        writer = open(self._segment_filename(segment), 'ab')
+                    data = zlib.compress(json.dumps(config))
+                    offset = writer.tell()
+                    writer.write(RECORD_HEADER.pack(len(data)))
+                    writer.write(data)
+                    index[jobid] = '%s %s %s' % (
+                        segment, offset + RECORD_HEADER.size, len(data))
+                writer.flush()
+                os.fsync(writer.fileno())
+            finally:
+                writer.close()
+                # closing syncs the index
+                index.close()
+            self._close_index()
+
+    def get(self, jobid):
+        with self.lock:
+            index = self._index()
+            if index is None or jobid not in index:
+                return None
+            (segment, offset, length) = [
+                int(v) for v in index[jobid].split()]
+        f = open(self._segment_filename(segment), 'rb')
+        try:
+            f.seek(offset)
+            return json.loads(zlib.decompress(f.read(length)))
+        finally:
+            f.close()
+
+    def close(self):
+        with self.lock:
+            self._close_index()
+
+    def _index(self):
+        if (self.index is not None and
+                time.time() - self.opened < self.refresh_interval):
+            return self.index
+        self._close_index()
+        try:
+            self.index = anydbm.open(self.index_filename, 'r')
+        except anydbm.error:
+            # nothing archived yet
+            return None
+        self.opened = time.time()
+        return self.index
+
+    def _close_index(self):
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+    def _last_segment(self):
+        segments = sorted(
+            f for f in os.listdir(self.directory) if f.startswith('segment-'))
+        if segments:
+            return int(segments[-1].split('-')[1])
+        return 0
+
+    def _segment_filename(self, segment):
+        return os.path.join(self.directory, 'segment-%08d' % segment)
+
+
+class Archiver(threading.Thread):
+    # enforces the retention of the queues configured with one, by moving
+    # their finished jobs from Redis to their system archive; only the
+    # leader of a system archives it, whatever the number of API processes
+    def __init__(self, manager, queues, interval=60):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.manager = manager
+        self.queues = [q for q in queues if 'retention' in q]
+        self.interval = interval
+        self.leaders = {}
+        for q in self.queues:
+            if q['system'] not in self.leaders:
+                queue = self.manager.get(q['system'], q['queue'])
+                # held across passes, lost once the leader stops renewing
+                self.leaders[q['system']] = sparqueue.reaper.Leader(
+                    manager.r, queue.prefix('archiver'), interval * 3)
+
+    def run(self):
+        while True:
+            try:
+                self.archive()
+            except Exception, e:
+                logger.error('problem archiving: %s' % traceback.format_exc(e))
+            time.sleep(self.interval)
+
+    def archive(self):
+        archived = 0
+        leading = set(
+            system for (system, leader) in self.leaders.iteritems()
+            if leader.acquire())
+        for q in self.queues:
+            if q['system'] not in leading:
+                continue
+            queue = self.manager.get(q['system'], q['queue'])
+            retention = q['retention']
+            count = queue.retire(
+                max_age=retention.get('max_age'),
+                max_count=retention.get('max_count'))
+            if count:
+                logger.info('archived %s jobs from %s/%s' % (
+                    count, q['system'], q['queue']))
+            archived = archived + count
+        return archived
@@ -1,5 +1,6 @@
 import json
 import os
+import sys
 
 import sparqueue.client
 import sparqueue.config
@@ -8,22 +9,44 @@ import sparqueue.config
 def submit(args):
     if type(args) is dict:
         obj = args
+    elif args.filename == '-' or args.lines:
+        return submit_lines(args)
     else:
         content = file(args.filename).read()
         obj = json.loads(content)
+    return SPARQUEUE_CLIENT.submit(with_user(obj))
+
+
+def submit_lines(args):
+    # one JSON job per line, read and submitted in batches so that memory
+    # stays constant whatever the size of the input
+    if args.filename == '-':
+        f = sys.stdin
+    else:
+        f = file(args.filename)
+    jobs = (with_user(json.loads(line)) for line in f if line.strip())
+    for jobid in SPARQUEUE_CLIENT.submit_many(jobs, args.batch):
+        print jobid
+
+
+def with_user(obj):
     if 'metadata' not in obj:
         obj['metadata'] = {}
     obj['metadata']['user'] = os.environ['USER']
-    return SPARQUEUE_CLIENT.submit(obj)
+    return obj
 
 
 def list_jobs(args):
-    l = SPARQUEUE_CLIENT.list()
+    l = SPARQUEUE_CLIENT.list(args.status)
     return format_json(l)
 
 
+def stats(args):
+    return format_json(SPARQUEUE_CLIENT.stats())
+
+
 def workers(args):
-    return format_json(SPARQUEUE_CLIENT.workers())
+    return format_json(SPARQUEUE_CLIENT.workers(args.status, args.rollup))
 
 
 def job(args):
@@ -31,16 +54,35 @@ def job(args):
 
 
 def status(args):
-    s = json.loads(SPARQUEUE_CLIENT.status(args.jobid))
+    if len(args.jobid) != 1 or args.jobid == ['-']:
+        return status_many(args)
+    s = json.loads(SPARQUEUE_CLIENT.status(args.jobid[0]))
     if args.text:
-        if s['step']:
-            return '%s;%s' % (s['state'], s['step'])
-        else:
-            return s['state']
+        return status_text(s)
     else:
         return format_json(s)
 
 
+def status_many(args):
+    # jobids from the command-line or one per line on stdin
+    jobids = args.jobid
+    if not jobids or jobids == ['-']:
+        jobids = [line.strip() for line in sys.stdin if line.strip()]
+    statuses = SPARQUEUE_CLIENT.status_many(jobids)
+    if args.text:
+        return '\n'.join(
+            '%s;%s' % (s['jobid'], status_text(s)) for s in statuses)
+    else:
+        return format_json(statuses)
+
+
+def status_text(s):
+    if s['step']:
+        return '%s;%s' % (s['state'], s['step'])
+    else:
+        return s['state']
+
+
 def traceback(args):
     obj = json.loads(SPARQUEUE_CLIENT.job(args.jobid))
     if 'traceback' in obj:
@@ -55,8 +97,7 @@ def worker_delete(args):
 
 def job_cancel(args):
     jobs = []
-    for jobid in args.jobid:
-        retvalue = SPARQUEUE_CLIENT.cancel(jobid)
+    for retvalue in SPARQUEUE_CLIENT.cancel_many(args.jobid):
         if retvalue:
             jobs.append(format_json(retvalue))
     if jobs:
@@ -109,16 +150,39 @@ def setup_parser(parser, subparsers, config, system, queue):
 
     submit_parser.add_argument(
         'filename',
-        help='filename to batch for upload')
+        help='filename to batch for upload (- for JSON lines from stdin)')
+    submit_parser.add_argument(
+        '-lines',
+        action='store_true', default=False,
+        help='file contains one JSON job per line')
+    submit_parser.add_argument(
+        '-batch',
+        type=int, default=1000,
+        help='jobs per request when submitting JSON lines')
 
     submit_parser.set_defaults(func=submit)
 
     list_parser = subparsers.add_parser(
         'list', help='listing of all jobs')
+    list_parser.add_argument(
+        '-status',
+        default=None,
+        help='only list jobs with status (SUCCESS, FAILED, ACTIVE, PENDING)')
     list_parser.set_defaults(func=list_jobs)
 
+    stats_parser = subparsers.add_parser(
+        'stats', help='job counts, throughput and wait and run times')
+    stats_parser.set_defaults(func=stats)
+
     workers_parser = subparsers.add_parser(
         'workers', help='list of all workers')
+    workers_parser.add_argument(
+        '-status',
+        help='only list workers with status (IDLE, PROCESSING, STALE)')
+    workers_parser.add_argument(
+        '-rollup',
+        action='store_true', default=False,
+        help='add the counts of workers per status and per host')
     workers_parser.set_defaults(func=workers)
 
     job_parser = subparsers.add_parser(
@@ -142,7 +206,8 @@ def setup_parser(parser, subparsers, config, system, queue):
 
     status_parser = subparsers.add_parser('status', help='retrieve job status')
     status_parser.add_argument(
-        'jobid', help='jobid to retrieve status from')
+        'jobid', nargs='*',
+        help='jobids to retrieve status from, read from stdin if none or -')
     status_parser.add_argument(
         '-text',
         action='store_true', default=False,
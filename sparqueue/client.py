@@ -1,40 +1,89 @@
-import urllib
-import json
+import errno
+import gzip
 import httplib
+import json
+import socket
+import StringIO
+import threading
+import time
+import urllib
 
 
 class ClientException(Exception):
     pass
 
 
+# methods whose requests are retried even if they may have been received
+IDEMPOTENT = set(['GET', 'HEAD', 'DELETE'])
+# statuses of requests that weren't processed and can be retried
+RETRY_STATUS = set([502, 503, 504])
+
+
+def closed_unanswered(e):
+    # whether the server closed the connection before sending any status
+    # line, which it does to an idle keep-alive connection
+    if isinstance(e, httplib.BadStatusLine):
+        return e.line == "''" or e.line.startswith('No status line')
+    return (isinstance(e, socket.error) and
+            e.errno in (errno.ECONNRESET, errno.EPIPE))
+
+
 class Client():
-    def __init__(self, protocol, hostname, port, system, queue):
+    # requests are sent over a pool of at most connections persistent
+    # connections, the idempotent ones are retried retries times on
+    # connection errors and busy servers
+    def __init__(self, protocol, hostname, port, system, queue,
+                 connections=4, retries=2, timeout=None):
         self.protocol = protocol
         self.hostname = hostname
         self.port = port
         self.system = system
         self.queue = queue
+        self.connections = connections
+        self.retries = retries
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
 
     def submit(self, job):
-        if type(job) is dict:
-            job_json = json.dumps(job)
-        elif type(job) is str:
-            job_json = job
-        else:
-            raise ClientException('Invalid type %s' % type(job))
+        job_json = self._job_json(job)
 
         params = urllib.urlencode({'job': job_json})
         uri = '/%s/queues/%s/jobs' % (self.system, self.queue)
-        url = self._url(uri)
-        f = urllib.urlopen(url, params)
-        output = f.read()
-
+        (resp, output) = self._request(
+            'POST', uri, params,
+            {'Content-Type': 'application/x-www-form-urlencoded'})
         return output
 
-    def list(self):
+    def submit_many(self, jobs, batch_size=1000):
+        # generator: jobs are consumed lazily and sent batch_size at a time
+        # as newline-delimited JSON, the jobids are yielded as they come back
+        uri = '/%s/queues/%s/jobs/batch' % (self.system, self.queue)
+        lines = []
+        for job in jobs:
+            lines.append(self._job_json(job, newlines=False))
+            if len(lines) >= batch_size:
+                for jobid in self._submit_lines(uri, lines):
+                    yield jobid
+                lines = []
+        if lines:
+            for jobid in self._submit_lines(uri, lines):
+                yield jobid
+
+    def list(self, status=None):
         uri = '/%s/queues/%s/jobs' % (self.system, self.queue)
+        if status:
+            uri = '%s?%s' % (uri, urllib.urlencode({'status': status}))
         return self._get(uri)
 
+    def list_page(self, status='EVERY', limit=100, cursor=0):
+        # returns the next cursor (0 at the end) and a page of jobs
+        uri = '/%s/queues/%s/jobs?%s' % (
+            self.system, self.queue, urllib.urlencode({
+                'status': status, 'limit': limit, 'cursor': cursor}))
+        (resp, output) = self._request('GET', uri)
+        return (int(resp.getheader('X-Sparqueue-Cursor')), output)
+
     def job(self, jobid):
         uri = '/%s/queues/%s/jobs/%s' % (self.system, self.queue, jobid)
         return self._get(uri)
@@ -43,8 +92,48 @@ class Client():
         uri = '/%s/queues/%s/jobs/%s/status' % (self.system, self.queue, jobid)
         return self._get(uri)
 
-    def workers(self):
+    def wait(self, jobid, timeout=30):
+        # blocks until the job is finished or timeout seconds elapsed, the
+        # state is not final on timeout
+        uri = '/%s/queues/%s/jobs/%s/wait?%s' % (
+            self.system, self.queue, jobid,
+            urllib.urlencode({'timeout': timeout}))
+        return self._get(uri)
+
+    def status_many(self, jobids, batch_size=1000):
+        # statuses of jobids in the same order, batch_size per request
+        uri = '/%s/queues/%s/jobs/status' % (self.system, self.queue)
+        return self._post_jobids(uri, jobids, batch_size)
+
+    def job_many(self, jobids, batch_size=1000):
+        # jobs of jobids in the same order, None for the unknown ones
+        uri = '/%s/queues/%s/jobs/fetch' % (self.system, self.queue)
+        return self._post_jobids(uri, jobids, batch_size)
+
+    def cancel_many(self, jobids, batch_size=1000):
+        # cancelled jobs in the order of jobids, None for the unknown ones
+        uri = '/%s/queues/%s/jobs/cancel' % (self.system, self.queue)
+        return self._post_jobids(uri, jobids, batch_size)
+
+    def close(self):
+        with self.lock:
+            (idle, self.idle) = (self.idle, [])
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        uri = '/%s/queues/%s/stats' % (self.system, self.queue)
+        return self._get(uri)
+
+    def workers(self, status=None, rollup=False):
         uri = '/%s/queues/%s/workers' % (self.system, self.queue)
+        query = {}
+        if status:
+            query['status'] = status
+        if rollup:
+            query['rollup'] = 1
+        if query:
+            uri = '%s?%s' % (uri, urllib.urlencode(query))
         return self._get(uri)
 
     def worker_delete(self, workerid):
@@ -56,17 +145,119 @@ class Client():
         return self._delete(uri)
 
     def _delete(self, uri):
-        conn = httplib.HTTPConnection(self.hostname, self.port)
-        conn.request('DELETE', uri)
-        resp = conn.getresponse()
-        content = resp.read()
+        (resp, content) = self._request('DELETE', uri)
         return content
 
+    def _submit_lines(self, uri, lines):
+        # yields the jobids of the jobs submitted, raises once they are
+        # yielded when the response ended before every job was submitted
+        jobids = self._post_lines(uri, lines)
+        for jobid in jobids:
+            yield jobid
+        if len(jobids) != len(lines):
+            raise ClientException(
+                'POST %s submitted %s of %s jobs, the response was cut' % (
+                    uri, len(jobids), len(lines)))
+
+    def _post_lines(self, uri, lines):
+        (resp, content) = self._request(
+            'POST', uri, '\n'.join(lines),
+            {'Content-Type': 'application/x-ndjson'})
+        if resp.status != 200:
+            raise ClientException('POST %s returned %s: %s' % (
+                uri, resp.status, content))
+        return content.split()
+
+    def _post_jobids(self, uri, jobids, batch_size, idempotent=True):
+        jobids = list(jobids)
+        results = []
+        for start in xrange(0, len(jobids), batch_size):
+            (resp, content) = self._request(
+                'POST', uri, json.dumps(jobids[start:start + batch_size]),
+                {'Content-Type': 'application/json'}, idempotent)
+            if resp.status != 200:
+                raise ClientException('POST %s returned %s: %s' % (
+                    uri, resp.status, content))
+            results.extend(json.loads(content))
+        return results
+
+    def _request(self, method, uri, body=None, headers={}, idempotent=None):
+        # returns the response and its content, decompressed
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT
+        headers = dict(headers)
+        headers['Accept-Encoding'] = 'gzip'
+        attempt = 0
+        while True:
+            (conn, reused) = self._connection()
+            stale = False
+            sending = True
+            resp = None
+            try:
+                conn.request(method, uri, body, headers)
+                sending = False
+                resp = conn.getresponse()
+                content = resp.read()
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                # the request wasn't received when it failed while being
+                # sent, or when a reused connection was closed by the server
+                # without any response; after a timeout it may have been
+                unanswered = sending or (
+                    reused and resp is None and closed_unanswered(e))
+                stale = reused and unanswered
+                if not stale and (attempt >= self.retries or
+                                  not (idempotent or unanswered)):
+                    raise
+            else:
+                if resp.will_close:
+                    conn.close()
+                else:
+                    self._release(conn)
+                if (resp.status not in RETRY_STATUS or
+                        attempt >= self.retries or not idempotent):
+                    if resp.getheader('Content-Encoding') == 'gzip':
+                        content = gzip.GzipFile(
+                            fileobj=StringIO.StringIO(content)).read()
+                    return (resp, content)
+            if not stale:
+                attempt = attempt + 1
+                time.sleep(0.1 * 2 ** attempt)
+
+    def _connection(self):
+        # an idle connection if there is one, and whether it is reused
+        with self.lock:
+            if self.idle:
+                return (self.idle.pop(), True)
+        if self.protocol == 'https':
+            conn = httplib.HTTPSConnection(
+                self.hostname, self.port, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(
+                self.hostname, self.port, timeout=self.timeout)
+        return (conn, False)
+
+    def _release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.connections:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def _job_json(self, job, newlines=True):
+        if type(job) is dict:
+            return json.dumps(job)
+        elif type(job) is str:
+            if not newlines and '\n' in job:
+                # one job per line when sent in batches
+                return json.dumps(json.loads(job))
+            return job
+        else:
+            raise ClientException('Invalid type %s' % type(job))
+
     def _url(self, uri):
         return "%s://%s:%s%s" % (self.protocol, self.hostname, self.port, uri)
 
     def _get(self, uri):
-        url = self._url(uri)
-        f = urllib.urlopen(url)
-        output = f.read()
+        (resp, output) = self._request('GET', uri)
         return output
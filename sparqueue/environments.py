@@ -0,0 +1,62 @@
+from __future__ import absolute_import
+
+import fcntl
+import hashlib
+import os
+import shutil
+import threading
+
+import sh
+
+import sparqueue.logging
+
+logger = sparqueue.logging.getLogger(__file__)
+
+
+class Environments():
+    # pip installs each requirement spec once, in its own directory under
+    # root named after a hash of the exact spec, shared by the worker
+    # processes of the host; pinned specs (package==1.2 or a git url
+    # @commit) are different environments for different versions
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+
+    def path(self, spec):
+        return os.path.join(
+            self.root, hashlib.sha1(spec.encode('utf-8')).hexdigest())
+
+    def install(self, spec):
+        # returns the directory of the environment of spec, installed if it
+        # isn't (anymore), raises sh.ErrorReturnCode when pip fails
+        path = self.path(spec)
+        if os.path.isdir(path):
+            return path
+        with self.lock:
+            if not os.path.isdir(path):
+                self.build(spec, path)
+        return path
+
+    def build(self, spec, path):
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                # created by another worker
+                pass
+        lock = open('%s.lock' % path, 'w')
+        try:
+            # one worker process installs it, the others wait and reuse it
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.isdir(path):
+                return
+            logger.info('installing %s in %s' % (spec, path))
+            temporary = '%s.%s.tmp' % (path, os.getpid())
+            try:
+                logger.info(sh.pip('install', '--target', temporary, spec))
+                os.rename(temporary, path)
+            finally:
+                if os.path.isdir(temporary):
+                    shutil.rmtree(temporary)
+        finally:
+            lock.close()
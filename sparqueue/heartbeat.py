@@ -0,0 +1,70 @@
+from __future__ import absolute_import
+
+import threading
+import time
+import traceback
+
+import sparqueue.logging
+import sparqueue.metrics
+
+logger = sparqueue.logging.getLogger(__file__)
+
+
+class Heartbeat(threading.Thread):
+    # renews the activity of every queue of the registered managers and the
+    # lease of every running job on an interval, in one pipeline, so that
+    # jobs going long without a step don't get requeued
+    def __init__(self, redisclient, interval=3):
+        threading.Thread.__init__(self, name='heartbeat')
+        self.daemon = True
+        self.r = redisclient
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.managers = []
+        self.jobs = {}  # jobid => queue
+
+    def add_manager(self, queue_manager):
+        with self.lock:
+            self.managers.append(queue_manager)
+
+    def remove_manager(self, queue_manager):
+        with self.lock:
+            self.managers.remove(queue_manager)
+
+    def started(self, queue, jobid):
+        with self.lock:
+            self.jobs[jobid] = queue
+
+    def finished(self, jobid):
+        with self.lock:
+            self.jobs.pop(jobid, None)
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.beat()
+            except Exception, e:
+                logger.error('problem renewing leases: %s' % (
+                    traceback.format_exc(e)))
+
+    def beat(self):
+        with self.lock:
+            queues = []
+            for queue_manager in self.managers:
+                queues.extend(queue_manager.queue_list)
+            jobs = self.jobs.items()
+
+        m = self.r.pipeline(transaction=False)
+        for queue in queues:
+            queue.active_worker(m)
+        for (jobid, queue) in jobs:
+            queue.active_job(jobid, m)
+        start = time.time()
+        m.execute()
+        sparqueue.metrics.METRICS.observe(
+            'sparqueue_redis_roundtrip_seconds', time.time() - start,
+            op='heartbeat')
@@ -0,0 +1,123 @@
+from __future__ import absolute_import
+
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+import sparqueue.logging
+import sparqueue.queue
+import sparqueue.scripts
+
+logger = sparqueue.logging.getLogger(__file__)
+
+# seconds without taking jobs after which the jobs a consumer was submitting
+# are given back to the incoming list
+CONSUMER_TIMEOUT = 60
+
+
+class Incoming(threading.Thread):
+    # submits the jobs pushed by clients directly on a Redis list: each one
+    # is a JSON job whose metadata names its system, queue and a uuid, the
+    # jobid of a uuid is kept ttl seconds in [list]|jobids|[uuid] and the
+    # jobs that can't be submitted are moved to the [list]|invalid list;
+    # jobs are moved to a processing list of the consumer until they are
+    # submitted, in the same transaction
+    def __init__(self, manager, key, batch=500, timeout=1, ttl=86400):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.manager = manager
+        self.r = manager.r
+        self.key = key
+        self.jobids_prefix = '%s|jobids|' % key
+        self.invalid_list = '%s|invalid' % key
+        self.consumers_set = '%s|consumers' % key
+        self.processing_prefix = '%s|processing|' % key
+        self.consumer = '%s.%s.%s' % (
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        self.processing_list = self.processing_prefix + self.consumer
+        self.batch = batch
+        self.timeout = timeout
+        self.ttl = ttl
+        self.take_script = self.r.register_script(
+            sparqueue.scripts.INCOMING_TAKE)
+
+    def run(self):
+        while True:
+            try:
+                self.ingest()
+            except Exception, e:
+                logger.error('problem ingesting: %s' % traceback.format_exc(e))
+                time.sleep(self.timeout)
+
+    def ingest(self):
+        # submits the jobs left by a failed attempt or blocks for the first
+        # job then takes the oldest ones, up to batch, returns how many were
+        # submitted
+        values = self.take()
+        if not values:
+            if not self.r.brpoplpush(
+                    self.key, self.processing_list, self.timeout):
+                return 0
+            values = self.take()
+        # clients lpush, the oldest jobs are at the end of the list
+        return self.submit(list(reversed(values)))
+
+    def take(self):
+        now = time.time()
+        return self.take_script(
+            keys=[self.key, self.processing_list, self.consumers_set],
+            args=[self.batch, self.consumer, now, now - CONSUMER_TIMEOUT,
+                  self.processing_prefix])
+
+    def submit(self, values):
+        # one transaction pushes the jobs, keeps their jobids and empties
+        # the processing list, a job whose uuid has a jobid already is
+        # skipped
+        configs = []
+        invalid = []
+        for value in values:
+            try:
+                (queue, config) = self.decode(value)
+            except (ValueError, KeyError, TypeError,
+                    sparqueue.queue.QueueException), e:
+                logger.error('Invalid incoming job %s: %s' % (value, e))
+                invalid.append(value)
+                continue
+            configs.append((queue, config))
+
+        uuids = [config['metadata'].get('uuid') for (queue, config) in configs]
+        known = set()
+        if any(uuids):
+            keys = [self.jobids_prefix + u for u in uuids if u]
+            known = set(
+                key[len(self.jobids_prefix):]
+                for (key, jobid) in zip(keys, self.r.mget(keys)) if jobid)
+
+        m = self.r.pipeline()
+        submitted = 0
+        for ((queue, config), job_uuid) in zip(configs, uuids):
+            if job_uuid in known:
+                continue
+            jobid = queue.push(config, m=m)
+            if job_uuid:
+                m.setex(self.jobids_prefix + job_uuid, jobid, self.ttl)
+            submitted = submitted + 1
+        if invalid:
+            m.lpush(self.invalid_list, *invalid)
+        m.delete(self.processing_list)
+        m.execute()
+        return submitted
+
+    def decode(self, value):
+        config = json.loads(value)
+        metadata = config['metadata']
+        queue = self.manager.get(metadata['system'], metadata['queue'])
+        queue.validate(config)
+        return (queue, config)
+
+    def jobid(self, uuid):
+        return self.r.get(self.jobids_prefix + uuid)
@@ -1,6 +1,9 @@
+import collections
 import importlib
 import os.path
 import sys
+import threading
+import time
 
 import logging
 
@@ -8,35 +11,85 @@ logger = logging.getLogger(__file__)
 
 
 class JobLoader():
-    def __init__(self):
+    # imports the job classes and keeps their instances by class name, at
+    # most max_instances of them (0 for no limit) and none unused for more
+    # than idle_timeout seconds (0 to keep them); the modules are checked
+    # for changes at most every reload_interval seconds (None disables the
+    # reloading)
+    def __init__(self, reload_interval=1, max_instances=64, idle_timeout=0):
+        self.reload_interval = reload_interval
+        self.max_instances = max_instances
+        self.idle_timeout = idle_timeout
         self.clazz_to_class = {}
-        self.clazz_to_object = {}
+        # least recently used first, clazz => (instance, last use)
+        self.clazz_to_object = collections.OrderedDict()
         self.clazz_to_timestamp = {}
+        self.clazz_to_checked = {}
         self.clazz_to_modulepath = {}
         self.clazz_to_module = {}
+        # shared by the concurrent slots of a worker
+        self.lock = threading.RLock()
 
     def getClass(self, clazz):
-        if clazz not in self.clazz_to_class:
-            self.clazz_to_class[clazz] = self._getClass(clazz)
-        return self.clazz_to_class[clazz]
+        with self.lock:
+            if clazz not in self.clazz_to_class:
+                self.clazz_to_class[clazz] = self._getClass(clazz)
+            return self.clazz_to_class[clazz]
 
     def getInstance(self, clazz, config, parameters=None):
+        with self.lock:
+            return self._getInstance(clazz, config, parameters)
+
+    def warm(self, classes, config):
+        # instantiates classes ahead of their first job, the ones that
+        # can't be loaded are logged and left for the job to fail
+        for clazz in classes:
+            logger.info('warming %s' % clazz)
+            try:
+                self.getInstance(clazz, config)
+            except Exception, e:
+                logger.error('problem warming %s: %s' % (clazz, e))
+
+    def _getInstance(self, clazz, config, parameters=None):
+        now = time.time()
+        if clazz in self.clazz_to_class:
+            self._reload(clazz, now)
+
         if clazz in self.clazz_to_object:
-            mtime = os.path.getmtime(self.clazz_to_modulepath[clazz])
-            if mtime > self.clazz_to_timestamp[clazz]:
-                del self.clazz_to_object[clazz]
-                m = self.clazz_to_module[clazz]
-                del self.clazz_to_module[clazz]
-                logger.info('reloading %s' % clazz)
-                self.clazz_to_module[clazz] = reload(m)
-                self.clazz_to_timestamp[clazz] = mtime
-
-        if clazz not in self.clazz_to_object:
-            clazz = self.getClass(clazz)
-            self.clazz_to_object[clazz] = clazz.instantiate(
-                config, parameters)
-
-        return self.clazz_to_object[clazz]
+            (instance, last) = self.clazz_to_object.pop(clazz)
+        else:
+            instance = self.getClass(clazz).instantiate(config, parameters)
+        self.clazz_to_object[clazz] = (instance, now)
+        self._evict(now)
+        return instance
+
+    def _reload(self, clazz, now):
+        if self.reload_interval is None:
+            return
+        if now - self.clazz_to_checked[clazz] < self.reload_interval:
+            return
+        self.clazz_to_checked[clazz] = now
+        mtime = os.path.getmtime(self.clazz_to_modulepath[clazz])
+        if mtime > self.clazz_to_timestamp[clazz]:
+            logger.info('reloading %s' % clazz)
+            self.clazz_to_object.pop(clazz, None)
+            m = reload(self.clazz_to_module[clazz])
+            self.clazz_to_module[clazz] = m
+            self.clazz_to_timestamp[clazz] = mtime
+            self.clazz_to_class[clazz] = getattr(m, clazz.split('.')[-1])
+
+    def _evict(self, now):
+        while self.clazz_to_object:
+            (clazz, (instance, last)) = next(
+                self.clazz_to_object.iteritems())
+            if (self.max_instances and
+                    len(self.clazz_to_object) > self.max_instances):
+                logger.info('evicting %s, too many instances' % clazz)
+            elif self.idle_timeout and now - last > self.idle_timeout:
+                logger.info('evicting %s, idle' % clazz)
+            else:
+                return
+            del self.clazz_to_object[clazz]
 
     def _getClass(self, clazz):
         components = clazz.split('.')
@@ -44,8 +97,13 @@ class JobLoader():
         clazz_only = components[-1]
         m = importlib.import_module(module_name)
         module_filename = os.path.abspath(sys.modules[module_name].__file__)
+        if (module_filename.endswith('.pyc') and
+                os.path.exists(module_filename[:-1])):
+            # the source is what gets edited
+            module_filename = module_filename[:-1]
         self.clazz_to_modulepath[clazz] = module_filename
         self.clazz_to_timestamp[clazz] = os.path.getmtime(module_filename)
+        self.clazz_to_checked[clazz] = time.time()
         self.clazz_to_module[clazz] = m
 
         return getattr(m, clazz_only)
@@ -0,0 +1,195 @@
+from __future__ import absolute_import
+
+import BaseHTTPServer
+import os
+import threading
+import traceback
+
+import sparqueue.logging
+
+logger = sparqueue.logging.getLogger(__file__)
+
+# upper bounds in seconds of the buckets of the duration histograms
+BUCKETS = [
+    0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600]
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+class Metrics():
+    # counters and histograms of a worker process by name and labels,
+    # rendered in the Prometheus text exposition format
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # name => {labels: value}
+        self.histograms = {}  # name => {labels: [counts per bucket, sum]}
+        self.gauges = {}  # name => function returning the value
+
+    def inc(self, name, value=1, **labels):
+        key = labels_key(labels)
+        with self.lock:
+            counter = self.counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = labels_key(labels)
+        with self.lock:
+            histogram = self.histograms.setdefault(name, {})
+            if key not in histogram:
+                histogram[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+            (counts, total) = histogram[key]
+            for (i, bound) in enumerate(BUCKETS):
+                if value <= bound:
+                    break
+            else:
+                i = len(BUCKETS)
+            counts[i] = counts[i] + 1
+            histogram[key][1] = total + value
+
+    def gauge(self, name, function):
+        with self.lock:
+            self.gauges[name] = function
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for (name, counter) in sorted(self.counters.iteritems()):
+                lines.append('# TYPE %s counter' % name)
+                for (key, value) in sorted(counter.iteritems()):
+                    lines.append('%s%s %r' % (name, format_labels(key), value))
+            for (name, histogram) in sorted(self.histograms.iteritems()):
+                lines.append('# TYPE %s histogram' % name)
+                for (key, (counts, total)) in sorted(histogram.iteritems()):
+                    cumulated = 0
+                    bounds = ['%g' % bound for bound in BUCKETS] + ['+Inf']
+                    for (bound, count) in zip(bounds, counts):
+                        cumulated = cumulated + count
+                        lines.append('%s_bucket%s %s' % (
+                            name, format_labels(key + (('le', bound),)),
+                            cumulated))
+                    lines.append('%s_sum%s %r' % (
+                        name, format_labels(key), total))
+                    lines.append('%s_count%s %s' % (
+                        name, format_labels(key), cumulated))
+            gauges = sorted(self.gauges.iteritems())
+        for (name, function) in gauges:
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %r' % (name, function()))
+        return '\n'.join(lines) + '\n'
+
+
+def labels_key(labels):
+    return tuple(sorted(labels.iteritems()))
+
+
+def format_labels(key):
+    if not key:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for (name, value) in key)
+
+
+def rss(pid):
+    # resident memory of process pid in bytes, 0 if it is gone
+    try:
+        f = open('/proc/%s/statm' % pid)
+        try:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        finally:
+            f.close()
+    except IOError:
+        return 0
+
+
+# shared by the slots and the heartbeat of a worker process
+METRICS = Metrics()
+METRICS.gauge(
+    'sparqueue_worker_rss_bytes',
+    lambda: rss(os.getpid()))
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPExporter(threading.Thread):
+    # serves the metrics on any path of host:port
+    def __init__(self, metrics, host, port):
+        threading.Thread.__init__(self, name='metrics')
+        self.daemon = True
+        self.server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+        self.server.metrics = metrics
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FileExporter(threading.Thread):
+    # rewrites filename every interval seconds, for the textfile collector
+    # of the node exporter
+    def __init__(self, metrics, filename, interval=15):
+        threading.Thread.__init__(self, name='metrics')
+        self.daemon = True
+        self.metrics = metrics
+        self.filename = filename
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        self.stopped.set()
+        self.write()
+
+    def write(self):
+        # renamed so that the collector never reads a partial file
+        temporary = '%s.%s.tmp' % (self.filename, os.getpid())
+        try:
+            f = open(temporary, 'w')
+            try:
+                f.write(self.metrics.render())
+            finally:
+                f.close()
+            os.rename(temporary, self.filename)
+        except Exception, e:
+            logger.error('problem writing metrics: %s' % (
+                traceback.format_exc(e)))
+
+
+def export(config, metrics=METRICS):
+    # starts the exporter configured by the metrics key of config, if any:
+    # {"port": 9108, "host": "0.0.0.0"} or {"file": "...", "interval": 15};
+    # prefork workers listen on port + their process index and the file name
+    # may contain %(pid)s
+    options = config.get('metrics')
+    if not options:
+        return None
+    if 'port' in options:
+        port = options['port'] + config.get('process', 0)
+        exporter = HTTPExporter(
+            metrics, options.get('host', '127.0.0.1'), port)
+        logger.info('serving metrics on port %s' % port)
+    else:
+        filename = options['file'] % {'pid': os.getpid()}
+        exporter = FileExporter(
+            metrics, filename, options.get('interval', 15))
+        logger.info('writing metrics to %s' % filename)
+    exporter.start()
+    return exporter
@@ -1,4 +1,5 @@
 import datetime
+import itertools
 import json
 import math
 import os
@@ -7,15 +8,76 @@ import socket
 import time
 import traceback
 
+import sparqueue.scripts
+import sparqueue.store
+
 # if we recreate the queue (due to disconnection),
 # we still want to have this counter correct for the process
-PROCESS_JOB_COUNTER = 0
+# shared by the threads pushing jobs, next() on it is atomic
+PROCESS_JOB_COUNTER = itertools.count(1)
 
 
 def unix_to_iso8601(unix):
     return datetime.datetime.fromtimestamp(unix).isoformat()
 
 
+def retry_delay(metadata, attempts):
+    # exponential backoff from metadata.backoff seconds (default 1),
+    # capped at metadata.backoff_max (default an hour)
+    delay = metadata.get('backoff', 1) * (2 ** attempts)
+    return min(delay, metadata.get('backoff_max', 3600))
+
+
+def histogram_summary(values):
+    # count, sum, mean, percentiles and count per bucket of a histogram
+    # hash, the percentiles are the upper bound of their bucket (None
+    # when it is +Inf)
+    count = int(values.get('count', 0))
+    total = float(values.get('sum', 0))
+    bounds = ['%g' % bound for bound in sparqueue.scripts.HISTOGRAM_BUCKETS]
+    buckets = [
+        (bound, int(values.get(bound, 0))) for bound in bounds + ['+Inf']]
+    summary = {
+        'count': count,
+        'sum': total,
+        'mean': total / count if count else None,
+        'buckets': buckets,
+    }
+    for percent in (50, 90, 99):
+        summary['p%s' % percent] = None
+        cumulated = 0
+        for (bound, bucket_count) in buckets:
+            cumulated = cumulated + bucket_count
+            if count and cumulated >= count * percent / 100.0:
+                if bound != '+Inf':
+                    summary['p%s' % percent] = float(bound)
+                break
+    return summary
+
+
+# priority lanes of a queue, in dequeue order
+PRIORITIES = ['high', 'normal', 'low']
+
+# statuses that can be listed
+LIST_STATUS = set([
+    'EVERY', 'SUCCESS', 'FAILED', 'ACTIVE', 'PENDING', 'SCHEDULED'])
+
+WORKER_STATUS = set(['IDLE', 'PROCESSING', 'STALE'])
+
+# seconds the per-minute counters of a queue are kept
+COUNTERS_TTL = 3900
+# minutes over which RedisQueue.stats reports the throughput
+THROUGHPUT_WINDOWS = [1, 5, 15, 60]
+# per-minute counters
+COUNTERS = ['pushed', 'success', 'failed', 'retried', 'cancelled']
+
+# commands queued by RedisQueue._status for a job
+STATUS_COMMANDS = 9
+
+# states after which a job no longer changes
+FINAL_STATUS = set(['SUCCESS', 'FAILED', 'CANCELLED'])
+
+
 class QueueException(Exception):
     pass
 
@@ -33,7 +95,8 @@ class QueueTimeoutException(QueueException):
 
 
 class RedisQueue():
-    def __init__(self, r, system, queue_name, config=None, separator='|'):
+    def __init__(self, r, system, queue_name, config=None, separator='|',
+                 slot=None):
         self.r = r
         self.system_name = system
         self.separator = separator
@@ -47,125 +110,386 @@ class RedisQueue():
         self.jobs_hash = self.prefix('queues', 'jobs')
         self.ongoing_hash = self.prefix('queues', queue_name, 'all')
         self.pending_list = self.prefix('queues', queue_name, 'pending')
+        # priority lanes, the normal one is the historical pending list
+        self.pending_lists = {
+            'high': self.prefix('queues', queue_name, 'pending', 'high'),
+            'normal': self.pending_list,
+            'low': self.prefix('queues', queue_name, 'pending', 'low'),
+        }
+        self.lanes = [self.pending_lists[p] for p in PRIORITIES]
         self.success_set = self.prefix('queues', queue_name, 'success')
         self.step_hash = self.prefix('queues', queue_name, 'step')
+        self.progress_hash = self.prefix('queues', queue_name, 'progress')
+        self.leases_set = self.prefix('queues', queue_name, 'leases')
+        self.finished_set = self.prefix('queues', queue_name, 'finished')
+        self.scheduled_set = self.prefix('queues', queue_name, 'scheduled')
+        self.events_channel = self.prefix('queues', queue_name, 'events')
+        # tokens for the workers blocked waiting for jobs, see pop
+        self.wakeup_list = self.prefix('queues', queue_name, 'wakeup')
+        self.wait_histogram = self.prefix(
+            'queues', queue_name, 'stats', 'wait')
+        self.run_histogram = self.prefix(
+            'queues', queue_name, 'stats', 'run')
+
+        # seconds without update before an active job is requeued
+        self.lease_timeout = (config or {}).get('lease_timeout', 10)
+
+        # the storage of the jobs of the system, recorded by the first
+        # process using the system and by sparqueue-migrate; a process
+        # configured with another one would lose the fields it writes
+        self.storage_key = self.prefix('storage')
+        configured = (config or {}).get('storage')
+        m = self.r.pipeline()
+        m.setnx(self.storage_key, configured or 'blob')
+        m.get(self.storage_key)
+        storage = m.execute()[1]
+        if configured and configured != storage:
+            raise QueueException(
+                'The jobs of %s are in the %s storage, not %s' % (
+                    system, storage, configured))
+        self.store = sparqueue.store.STORES[storage](
+            self.r, self.jobs_hash, self.prefix('jobs', ''))
+        # sparqueue.archive.Archive of the system, if any
+        self.archive = None
+        # publish job state changes on events_channel
+        self.events = (config or {}).get('events', True)
+        # seconds the completion of a job is kept for its waiters
+        self.done_ttl = (config or {}).get('done_ttl', 300)
 
         self.hostname = socket.gethostname()
         self.pid = os.getpid()
-        self.client_id = '%s.%s.%s' % (self.hostname, self.pid, time.time())
+        if slot is None:
+            process = self.pid
+        else:
+            # one identity per concurrent slot of a worker process
+            process = '%s-%s' % (self.pid, slot)
+        self.client_id = '%s.%s.%s' % (self.hostname, process, time.time())
+
+        self.dequeue_script = self.r.register_script(
+            sparqueue.scripts.DEQUEUE)
+        self.activate_script = self.r.register_script(
+            sparqueue.scripts.ACTIVATE)
+        self.requeue_script = self.r.register_script(
+            sparqueue.scripts.REQUEUE)
+        self.promote_script = self.r.register_script(
+            sparqueue.scripts.PROMOTE)
+        self.workers_script = self.r.register_script(
+            sparqueue.scripts.WORKERS)
+        self.finish_script = self.r.register_script(
+            sparqueue.scripts.FINISH)
+
+    def dequeue_keys(self, lane=None):
+        # keys used by the activation scripts, see sparqueue.scripts
+        if lane is None:
+            lane = self.pending_list
+        return [
+            lane,
+            self.cancelled_hash,
+            self.ongoing_hash,
+            self.activity_hash,
+            self.current_hash,
+            self.jobs_hash,
+            self.leases_set,
+            self.wait_histogram]
+
+    def activate_args(self):
+        # arguments used by the activation scripts, see sparqueue.scripts
+        return [
+            self.client_id,
+            self.lease_expiry(),
+            self.store.job_prefix] + self.event_args()
+
+    def event_args(self):
+        if self.events:
+            channel = self.events_channel
+        else:
+            channel = ''
+        return [channel, self.system_name, self.queue_name]
+
+    def lease_expiry(self):
+        return time.time() + self.lease_timeout
 
     def exit(self):
         self.r.hdel(self.activity_hash, self.client_id)
 
-    def workers(self):
-        retlist = []
-        workers = self.r.hgetall(self.activity_hash)
-        if not workers:
-            return retlist
+    def workers(self, status=None):
+        return self.worker_registry(status)['workers']
+
+    def worker_registry(self, status=None):
+        # the workers (only the ones in status if given) with their current
+        # job, step and lease age read by one script, and their counts per
+        # status and per host
+        values = self.workers_script(keys=[
+            self.activity_hash,
+            self.current_hash,
+            self.step_hash,
+            self.leases_set])
+        workers = []
+        statuses = {}
+        hosts = {}
+        for i in xrange(0, len(values), 5):
+            (workerid, last, jobid, step, expiry) = values[i:i + 5]
+            info = self._worker_info(
+                float(last), workerid, jobid, step, expiry)
+            if status and info['status'] != status:
+                continue
+            workers.append(info)
+            statuses[info['status']] = statuses.get(info['status'], 0) + 1
+            host = hosts.setdefault(info['hostname'], {})
+            host[info['status']] = host.get(info['status'], 0) + 1
+        return {
+            'workers': workers,
+            'statuses': statuses,
+            'hosts': hosts
+        }
 
-        for w in workers:
-            last = float(workers[w])
-            retlist.append(self._worker_info(last, w))
+    def stats(self):
+        # number of jobs per state and of workers, throughput over the last
+        # minutes and wait and run time histograms, in one pipeline
+        now = time.time()
+        minute = int(now // 60)
+        m = self.r.pipeline(transaction=False)
+        for lane in self.lanes:
+            m.llen(lane)
+        m.zcard(self.scheduled_set)
+        m.zcard(self.leases_set)
+        m.scard(self.success_set)
+        m.scard(self.failed_set)
+        m.scard(self.cancelled_hash)
+        m.hlen(self.activity_hash)
+        m.hgetall(self.wait_histogram)
+        m.hgetall(self.run_histogram)
+        # the current minute and the complete ones of the longest window
+        for i in xrange(max(THROUGHPUT_WINDOWS) + 1):
+            m.hgetall(self._counters((minute - i) * 60))
+        results = m.execute()
 
-        return retlist
+        lanes = len(self.lanes)
+        (scheduled, active, success, failed, cancelled, workers, waits,
+            runs) = results[lanes:lanes + 8]
+        minutes = results[lanes + 8:]
+        throughput = {}
+        for window in THROUGHPUT_WINDOWS:
+            counts = dict((counter, 0) for counter in COUNTERS)
+            for counters in minutes[:window]:
+                for (counter, count) in counters.iteritems():
+                    counts[counter] = counts.get(counter, 0) + int(count)
+            # over the complete minutes, the current one isn't over
+            finished = sum(
+                int(counters.get('success', 0)) +
+                int(counters.get('failed', 0))
+                for counters in minutes[1:window + 1])
+            counts['rate'] = finished / (window * 60.0)
+            throughput['%sm' % window] = counts
+        return {
+            'pending': sum(results[:lanes]),
+            'lanes': dict(zip(PRIORITIES, results[:lanes])),
+            'scheduled': scheduled,
+            'active': active,
+            'success': success,
+            'failed': failed,
+            'cancelled': cancelled,
+            'workers': workers,
+            'throughput': throughput,
+            'wait': histogram_summary(waits),
+            'run': histogram_summary(runs),
+        }
 
     def worker_delete(self, workerid):
         m = self.r.pipeline()
         m.hget(self.activity_hash, workerid)
+        m.hget(self.current_hash, workerid)
         m.hdel(self.activity_hash, workerid)
         results = m.execute()
-        return self._worker_info(float(results[0]), workerid)
-
-    def push(self, config):
-        assert 'vars' in config
-        assert 'class' in config
-        global PROCESS_JOB_COUNTER
-        PROCESS_JOB_COUNTER = PROCESS_JOB_COUNTER + 1
-        self.timestamp = time.time()
-        jobid = "%s.%s.%s.%s" % (
-            self.hostname, self.pid, self.timestamp, PROCESS_JOB_COUNTER)
-        if 'metadata' not in config:
-            config['metadata'] = {}
-        config['metadata']['jobid'] = jobid
-        config['metadata']['queue'] = self.queue_name
-        config['metadata']['system'] = self.system_name
+        if results[0] is None:
+            return None
+        return self._worker_info(float(results[0]), workerid, results[1])
 
+    def reap_workers(self, timeout=60):
+        # removes the workers without activity for more than timeout seconds
+        workers = self.r.hgetall(self.activity_hash)
+        now = time.time()
+        stale = [workerid for (workerid, last) in workers.iteritems()
+                 if now - float(last) > timeout]
+        if stale:
+            m = self.r.pipeline()
+            m.hdel(self.activity_hash, *stale)
+            m.hdel(self.current_hash, *stale)
+            m.execute()
+        return stale
+
+    def push(self, config, run_at=None, m=None):
+        # in pipeline m if given, executed by the caller
+        if m is not None:
+            return self._push(m, config, run_at)
         m = self.r.pipeline()
-        m.hset(self.jobs_hash, jobid, json.dumps(config))
-        m.lpush(self.pending_list, jobid)
-        m.hset(self.ongoing_hash, jobid, time.time())
+        jobid = self._push(m, config, run_at)
         m.execute()
 
         return jobid
 
-    def active_worker(self):
+    def push_many(self, configs, chunk_size=500):
+        # generator: configs are consumed lazily and written in pipelines
+        # of chunk_size jobs, the jobids are yielded once their chunk is
+        # executed
+        m = self.r.pipeline()
+        jobids = []
+        for config in configs:
+            jobids.append(self._push(m, config))
+            if len(jobids) >= chunk_size:
+                m.execute()
+                for jobid in jobids:
+                    yield jobid
+                jobids = []
+        if jobids:
+            m.execute()
+            for jobid in jobids:
+                yield jobid
+
+    def active_worker(self, m=None):
         # we update the activity timestamp for the current worker
-        self.r.hset(self.activity_hash, self.client_id, time.time())
-
-    def active_job(self, jobid):
-        self.r.hset(self.ongoing_hash, jobid, time.time())
+        if m is None:
+            m = self.r
+        m.hset(self.activity_hash, self.client_id, time.time())
+
+    def active_job(self, jobid, m=None):
+        # renews the lease of jobid, in pipeline m if given; XX so that a
+        # lease already finalized or requeued isn't recreated
+        if m is None:
+            m = self.r
+        m.execute_command(
+            'ZADD', self.leases_set, 'XX', self.lease_expiry(), jobid)
 
     def pop(self, timeout=3):
-        self.active_worker()
-
-        # block pop with catchable exception
-        retvalue = self.r.brpop(self.pending_list, timeout)
-        if not retvalue:
+        # the job is popped and activated by one script, only the wait for
+        # a job blocks on the wakeup list
+        job = self._dequeue()
+        if job is None:
+            self.r.brpop(self.wakeup_list, timeout)
+            job = self._dequeue()
+        if job is None:
             raise QueueTimeoutException(
                 'brpop returned null for %s due to timeout - please retry' % (
-                    self.pending_list))
-        (key, jobid) = retvalue
-
-        self.activate_job(self, jobid)
+                    self.wakeup_list))
+        return job
+
+    def _dequeue(self):
+        keys = []
+        args = [time.time()]
+        for lane in self.lanes:
+            keys.extend(self.dequeue_keys(lane))
+            args.extend(self.activate_args())
+        retvalue = self.dequeue_script(keys=keys, args=args)
+        if not retvalue:
+            return None
+        return self.store.decode_script(retvalue[2])
 
     def activate_job(self, jobid):
-        if self.r.sismember(self.cancelled_hash, jobid):
+        # checks for cancellation and sets all related information
+        # in a single atomic script
+        config = self.activate_script(
+            keys=self.dequeue_keys(),
+            args=[time.time(), jobid] + self.activate_args())
+        if not config:
             raise QueueJobCancelledException(
                 'jobid is cancelled %s - please retry' % jobid)
 
-        # use the jobid and set all related information
-        m = self.r.pipeline()
-        m.hget(self.jobs_hash, jobid)
-        m.hset(self.ongoing_hash, jobid, time.time())
-        m.hset(self.current_hash, self.client_id, jobid)
-        retvalue = m.execute()
-
-        config = retvalue[0]
-
-        return json.loads(config)
-
-    def success(self, output, stats={}):
-        (jobid, current) = self._get_current_job()
-
-        current['output'] = output
-        current['stats'] = stats
-
-        self._finalize(jobid, self.success_set, current)
-
-    def failed(self, e):
-        (jobid, current) = self._get_current_job()
-        current['last_error'] = str(e)
-        current['traceback'] = traceback.format_exc(e)
-
-        self._finalize(jobid, self.failed_set, current)
+        return self.store.decode_script(config)
+
+    def success(self, output, stats={}, jobid=None):
+        if jobid is None:
+            jobid = self._get_current_jobid()
+
+        self._finalize(jobid, self.success_set, {
+            'output': output,
+            'stats': stats})
+
+    def failed(self, e, jobid=None):
+        if jobid is None:
+            jobid = self._get_current_jobid()
+
+        fields = {
+            'last_error': str(e),
+            'traceback': traceback.format_exc(e)}
+
+        # retried with a backoff until metadata.max_retries is reached
+        job = self.store.load(jobid, ['metadata']) or {}
+        metadata = job.get('metadata', {})
+        attempts = metadata.get('attempts', 0)
+        if attempts < metadata.get('max_retries', 0):
+            metadata['attempts'] = attempts + 1
+            fields['metadata'] = metadata
+            run_at = time.time() + retry_delay(metadata, attempts)
+            self._finalize(jobid, None, fields, run_at)
+        else:
+            self._finalize(jobid, self.failed_set, fields)
+
+    def promote(self, batch=500):
+        # moves the scheduled jobs that are due to their pending lane in
+        # bounded batches, returns how many were moved
+        promoted = 0
+        while True:
+            count = self.promote_script(
+                keys=[
+                    self.scheduled_set,
+                    self.ongoing_hash,
+                    self.jobs_hash] + self.lanes + [self.wakeup_list],
+                args=[time.time(), batch] + self.event_args())
+            promoted = promoted + count
+            if count < batch:
+                break
+        return promoted
 
     def status(self, jobid):
-        m = self.r.pipeline()
-        IS_ONGOING = 0
+        status = self.status_many([jobid])[0]
+        del status['jobid']
+        return status
+
+    def status_many(self, jobids, chunk_size=500):
+        # statuses of jobids in one pipeline per chunk_size jobs
+        statuses = []
+        for start in xrange(0, len(jobids), chunk_size):
+            chunk = jobids[start:start + chunk_size]
+            m = self.r.pipeline()
+            for jobid in chunk:
+                self._status(m, jobid)
+            results = m.execute()
+            for (i, jobid) in enumerate(chunk):
+                offset = i * STATUS_COMMANDS
+                status = self._decode_status(
+                    jobid, results[offset:offset + STATUS_COMMANDS])
+                status['jobid'] = jobid
+                statuses.append(status)
+        return statuses
+
+    def _status(self, m, jobid):
+        # queues the STATUS_COMMANDS commands read by _decode_status
         m.hexists(self.ongoing_hash, jobid)  # 0
-        IS_EXIST = 1
         m.hexists(self.jobs_hash, jobid)  # 1
-        IS_FAILED = 2
         m.sismember(self.failed_set, jobid)  # 2
-        IS_SUCCESS = 3
         m.sismember(self.success_set, jobid)  # 3
-        IS_CANCELLED = 4
         m.sismember(self.cancelled_hash, jobid)  # 4
+        m.hget(self.step_hash, jobid)  # 5
+        m.zscore(self.scheduled_set, jobid)  # 6
+        m.hget(self.progress_hash, jobid)  # 7
+        m.zscore(self.leases_set, jobid)  # 8
+
+    def _decode_status(self, jobid, states):
+        IS_ONGOING = 0
+        IS_EXIST = 1
+        IS_FAILED = 2
+        IS_SUCCESS = 3
+        IS_CANCELLED = 4
         STEP = 5
-        m.hget(self.step_hash, jobid)
-        states = m.execute()
+        RUN_AT = 6
+        PROGRESS = 7
+        LEASE = 8
 
         state = 'UNKNOWN'
+        if not states[IS_EXIST] and self.archive:
+            job = self.archive.get(jobid)
+            if job:
+                state = job['metadata']['status']
         if states[IS_EXIST]:
             if states[IS_FAILED]:
                 state = 'FAILED'
@@ -173,102 +497,392 @@ class RedisQueue():
                 state = 'SUCCESS'
             elif states[IS_CANCELLED]:
                 state = 'CANCELLED'
-            elif states[IS_ONGOING]:
+            elif states[RUN_AT] is not None:
+                state = 'SCHEDULED'
+            elif states[LEASE] is not None:
+                # as listed, active jobs are the leased ones
                 state = 'ACTIVE'
+            elif states[IS_ONGOING]:
+                state = 'PENDING'
 
+        progress = states[PROGRESS]
+        if progress is not None:
+            progress = float(progress)
+        elif state == 'SUCCESS':
+            progress = 100.0
         return {
             'state': state,
-            'step': states[STEP]
+            'step': states[STEP],
+            'progress': progress
         }
 
-    def job(self, jobid):
-        return json.loads(self.r.hget(self.jobs_hash, jobid))
+    def wait(self, jobid, timeout=30, client=None):
+        # blocks until jobid is finished or timeout seconds elapsed, returns
+        # its status with its output (or error) once finished; client is
+        # the Redis client to block with, if not this queue's
+        status = self.status(jobid)
+        if status['state'] not in FINAL_STATUS and timeout > 0:
+            done = self.done_key(jobid)
+            # popping and pushing back the same list leaves the completion
+            # for the other waiters of jobid
+            state = (client or self.r).brpoplpush(
+                done, done, max(1, int(timeout)))
+            if state:
+                status = self.status(jobid)
+                if status['state'] == 'UNKNOWN':
+                    # cancelled jobs are deleted
+                    status['state'] = state
+        status['jobid'] = jobid
+        if status['state'] in ('SUCCESS', 'FAILED'):
+            job = self.job(jobid, ['output', 'last_error'])
+            if job:
+                status['output'] = job.get('output')
+                status['last_error'] = job.get('last_error')
+        return status
+
+    def done_key(self, jobid):
+        return self.prefix('queues', self.queue_name, 'done', jobid)
+
+    def job(self, jobid, fields=None):
+        return self.jobs_many([jobid], fields)[0]
+
+    def jobs_many(self, jobids, fields=None, chunk_size=500):
+        # jobs of jobids (None for the unknown ones) in one pipeline per
+        # chunk_size jobs
+        jobs = []
+        for start in xrange(0, len(jobids), chunk_size):
+            chunk = jobids[start:start + chunk_size]
+            m = self.r.pipeline()
+            counts = [self.store.fetch(m, jobid, fields) for jobid in chunk]
+            results = m.execute()
+            offset = 0
+            for (jobid, count) in zip(chunk, counts):
+                job = self.store.decode(results[offset:offset + count], fields)
+                if job is None and self.archive:
+                    job = self.archive.get(jobid)
+                jobs.append(job)
+                offset = offset + count
+        return jobs
 
-    def requeue(self, timeout=10):
-        # since ongoing_hash may change while we're checking
-        # we want to use optimistic locking and retry
-        # if that key change
+    def retire(self, max_age=None, max_count=None, batch=500):
+        # moves the finished jobs over the retention limits to the archive
+        # (or drops them without one), oldest first and batch at a time
+        retired = 0
+        while True:
+            jobids = set()
+            if max_age is not None:
+                jobids.update(self.r.zrangebyscore(
+                    self.finished_set, '-inf', time.time() - max_age,
+                    start=0, num=batch))
+            if max_count is not None:
+                over = self.r.zcard(self.finished_set) - max_count
+                if over > 0:
+                    jobids.update(self.r.zrange(
+                        self.finished_set, 0, min(over, batch) - 1))
+            if not jobids:
+                break
+            self._retire(list(jobids))
+            retired = retired + len(jobids)
+        return retired
+
+    def requeue(self, batch=100):
+        # leases are scored by expiry time so expired jobs are a single
+        # range query, moved in bounded batches by an atomic script
         requeued = []
-        with self.r.pipeline() as pipe:
-            while 1:
-                try:
-                    pipe.watch(self.ongoing_hash)
-                    pipe.watch(self.pending_list)
-                    jobids = self.r.hkeys(self.ongoing_hash)
-                    pending = self.r.lrange(self.pending_list, 0, -1)
-                    pipe.multi()
-                    for jobid in jobids:
-                        # if the jobid has timed out
-                        last_update = float(self.r.hget(
-                            self.ongoing_hash, jobid))
-                        if time.time() - last_update > timeout:
-                            # and the jobid is not in the list of pending keys
-                            try:
-                                pending.index(jobid)
-                            except ValueError:
-                                # push back to pending
-                                requeued.append(jobid)
-                                pipe.lpush(self.pending_list, jobid)
-                                pipe.hset(
-                                    self.ongoing_hash, jobid, time.time())
-                    pipe.execute()
-                    break
-                except redis.WatchError:
-                    continue
+        while True:
+            (count, jobids) = self.requeue_script(
+                keys=[
+                    self.leases_set,
+                    self.cancelled_hash,
+                    self.ongoing_hash,
+                    self.jobs_hash] + self.lanes + [self.wakeup_list],
+                args=[time.time(), batch] + self.event_args())
+            requeued.extend(jobids)
+            if count < batch:
+                break
         return requeued
 
     def list(self, status=set(['EVERY']), selector=set(['metadata'])):
-        jobids = set()
-        success = set()
-        failed = set()
-        pending = set()
-        every = set()
-        cancelled = set()
+        if 'EVERY' in status:
+            status = ['EVERY']
+        jobs = []
+        for s in status:
+            jobs.extend(self.iterate(s, selector=selector))
+        return jobs
+
+    def iterate(self, status='EVERY', limit=100, selector=set(['metadata'])):
+        # generator over every job of the given status, fetched one page
+        # at a time so memory is bounded by the page size
+        cursor = 0
+        while True:
+            (cursor, jobs) = self.scan(status, cursor, limit, selector)
+            for job in jobs:
+                yield job
+            if not cursor:
+                break
+
+    def scan(self, status='EVERY', cursor=0, limit=100,
+             selector=set(['metadata'])):
+        # one page of jobs with the given status, returns the next cursor
+        # and the jobs, a next cursor of 0 ends the listing
+        cursor = int(cursor)
+        limit = int(limit)
+        configs = None
+        if status == 'EVERY':
+            (cursor, scanned) = self.r.hscan(
+                self.jobs_hash, cursor, count=limit)
+            jobids = scanned.keys()
+            if self.store.complete(selector):
+                configs = scanned
+        elif status == 'SUCCESS':
+            (cursor, jobids) = self.r.sscan(
+                self.success_set, cursor, count=limit)
+        elif status == 'FAILED':
+            (cursor, jobids) = self.r.sscan(
+                self.failed_set, cursor, count=limit)
+        elif status == 'ACTIVE':
+            (cursor, leases) = self.r.zscan(
+                self.leases_set, cursor, count=limit)
+            jobids = [jobid for (jobid, expiry) in leases]
+        elif status == 'SCHEDULED':
+            (cursor, scheduled) = self.r.zscan(
+                self.scheduled_set, cursor, count=limit)
+            jobids = [jobid for (jobid, run_at) in scheduled]
+        elif status == 'PENDING':
+            # lists can't be scanned, the cursor is an offset in the lanes
+            # taken one after the other
+            jobids = self._range_lanes(cursor, limit)
+            if len(jobids) == limit:
+                cursor = cursor + limit
+            else:
+                cursor = 0
+        else:
+            raise QueueException('Invalid status: %s' % status)
+        return (cursor, self._describe(jobids, selector, configs))
+
+    def cancel(self, jobid):
+        return self.cancel_many([jobid])[0]
 
+    def cancel_many(self, jobids, chunk_size=500):
+        # cancels jobids in pipelines of chunk_size jobs, returns the
+        # cancelled jobs (None for the unknown ones)
+        jobs = []
+        for start in xrange(0, len(jobids), chunk_size):
+            m = self.r.pipeline()
+            counts = [
+                self._cancel(m, jobid)
+                for jobid in jobids[start:start + chunk_size]]
+            results = m.execute()
+            offset = 0
+            for (fetched, count) in counts:
+                jobs.append(self.store.decode(
+                    results[offset + 1:offset + 1 + fetched]))
+                offset = offset + count
+        return jobs
+
+    def _cancel(self, m, jobid):
+        # queues the cancellation of jobid, returns how many commands
+        # fetching the job follow the first one and how many were queued;
+        # if it's active, there's not much to be done except if the job
+        # explicitly checks for cancellation?
+        queued = len(m.command_stack)
+        # we mark this as cancelled in case it's requeued
+        m.sadd(self.cancelled_hash, jobid)
+        # we fetch and delete from jobs key
+        count = self.store.fetch(m, jobid)
+        self.store.delete(m, jobid)
+        # we delete from whatever start or end states we can
+        m.srem(self.success_set, jobid)
+        m.srem(self.failed_set, jobid)
+        m.hdel(self.ongoing_hash, jobid)
+        m.zrem(self.leases_set, jobid)
+        m.zrem(self.scheduled_set, jobid)
+        m.hdel(self.progress_hash, jobid)
+        # cancelled ids are dropped from the cancelled set on retirement
+        m.zadd(self.finished_set, jobid, time.time())
+        self._publish(m, jobid, 'CANCELLED')
+        self._done(m, jobid, 'CANCELLED')
+        self._count(m, 'cancelled')
+        return (count, len(m.command_stack) - queued)
+
+    def step(self, jobid, stepname, progress=None):
         m = self.r.pipeline()
-        m.smembers(self.success_set),
-        m.smembers(self.failed_set),
-        m.lrange(self.pending_list, 0, -1),
-        m.hkeys(self.jobs_hash)
-        m.smembers(self.cancelled_hash)
-        results = m.execute()
+        self.report(m, jobid, stepname, progress)
+        return m.execute()[2]
+
+    def report(self, m, jobid, stepname, progress=None):
+        # queues the update of the step of jobid and of its percent done
+        # in the step, if known, renewing the worker and the job lease
+        self.active_worker(m)
+        self.active_job(jobid, m)
+        m.hset(self.step_hash, jobid, stepname)
+        if progress is None:
+            m.hdel(self.progress_hash, jobid)
+        else:
+            m.hset(self.progress_hash, jobid, progress)
+        self._publish(m, jobid, 'ACTIVE', step=stepname, progress=progress)
+
+    def validate(self, config):
+        # raises QueueException when config can't be pushed
+        if (not isinstance(config, dict) or 'class' not in config or
+                'vars' not in config):
+            raise QueueException('class and vars are required')
+        priority = config.get('metadata', {}).get('priority', 'normal')
+        if priority not in self.pending_lists:
+            raise QueueException('Invalid priority: %s' % priority)
+
+    def _push(self, m, config, run_at=None):
+        self.validate(config)
+        self.timestamp = time.time()
+        jobid = "%s.%s.%s.%s" % (
+            self.hostname, self.pid, self.timestamp, next(PROCESS_JOB_COUNTER))
+        if 'metadata' not in config:
+            config['metadata'] = {}
+        priority = config['metadata'].get('priority', 'normal')
+        config['metadata']['jobid'] = jobid
+        config['metadata']['queue'] = self.queue_name
+        config['metadata']['system'] = self.system_name
 
-        success.update(results[0])
-        failed.update(results[1])
-        pending.update(results[2])
-        every.update(results[3])
-        cancelled.update(results[4])
+        if run_at is None:
+            run_at = config['metadata'].get('run_at')
 
-        pending.difference_update(cancelled)
+        self.store.save(m, jobid, config)
+        if run_at and run_at > time.time():
+            m.zadd(self.scheduled_set, jobid, run_at)
+            self._publish(m, jobid, 'SCHEDULED')
+        else:
+            m.lpush(self.pending_lists[priority], jobid)
+            self._wake(m, 1)
+            self._publish(m, jobid, 'PENDING')
+        m.hset(self.ongoing_hash, jobid, time.time())
+        self._count(m, 'pushed')
 
-        if 'SUCCESS' in status:
-            jobids.update(success)
-        if 'FAILED' in status:
-            jobids.update(failed)
-        if 'PENDING' in status:
-            jobids.update(pending)
-        if 'EVERY' in status:
-            jobids.update(every)
+        return jobid
+
+    def _finalize(self, jobid, key, fields, run_at=None):
+        # ends the run of jobid in the key set, or schedules it to run
+        # again at run_at; a job cancelled while active is gone and only
+        # the worker is released
+        m = self.r.pipeline()
+        if self.store.update(m, jobid, fields):
+            if key:
+                m.sadd(key, jobid)
+                m.zadd(self.finished_set, jobid, time.time())
+                if key == self.success_set:
+                    state = 'SUCCESS'
+                else:
+                    state = 'FAILED'
+                self._publish(m, jobid, state)
+                self._done(m, jobid, state)
+            else:
+                state = 'RETRIED'
+                m.zadd(self.scheduled_set, jobid, run_at)
+                self._publish(m, jobid, 'SCHEDULED')
+            # run time from the activation time, before it is deleted
+            now = time.time()
+            self.finish_script(
+                keys=[self.ongoing_hash, self.run_histogram,
+                      self._counters(now)],
+                args=[jobid, now, state.lower(), COUNTERS_TTL],
+                client=m)
+        m.hdel(self.current_hash, self.client_id)
+        m.hdel(self.ongoing_hash, jobid)
+        m.zrem(self.leases_set, jobid)
+        m.hdel(self.step_hash, jobid)
+        m.hdel(self.progress_hash, jobid)
+        m.execute()
+
+    def _wake(self, m, count):
+        # tokens for the workers blocked in pop, see sparqueue.scripts
+        tokens = sparqueue.scripts.WAKEUP_TOKENS
+        m.lpush(self.wakeup_list, *([1] * min(count, tokens)))
+        m.ltrim(self.wakeup_list, 0, tokens - 1)
+
+    def _counters(self, now=None):
+        # hash of the number of jobs pushed, finished... during the minute
+        if now is None:
+            now = time.time()
+        return self.prefix(
+            'queues', self.queue_name, 'stats', str(int(now // 60)))
+
+    def _count(self, m, counter):
+        counters = self._counters()
+        m.hincrby(counters, counter, 1)
+        m.expire(counters, COUNTERS_TTL)
+
+    def _done(self, m, jobid, state):
+        # wakes up the waiters of jobid
+        done = self.done_key(jobid)
+        m.lpush(done, state)
+        m.expire(done, self.done_ttl)
+
+    def _publish(self, m, jobid, state, **extra):
+        if not self.events:
+            return
+        event = {
+            'system': self.system_name,
+            'queue': self.queue_name,
+            'jobid': jobid,
+            'state': state,
+            'time': time.time()}
+        event.update(extra)
+        m.publish(self.events_channel, json.dumps(event))
+
+    def _range_lanes(self, start, limit):
+        m = self.r.pipeline()
+        for lane in self.lanes:
+            m.llen(lane)
+        lengths = m.execute()
 
+        m = self.r.pipeline()
+        for (lane, length) in zip(self.lanes, lengths):
+            if start < length and limit > 0:
+                stop = min(start + limit, length)
+                m.lrange(lane, start, stop - 1)
+                limit = limit - (stop - start)
+            start = max(0, start - length)
+        jobids = []
+        for result in m.execute():
+            jobids.extend(result)
+        return jobids
+
+    def _describe(self, jobids, selector, configs=None):
+        # configs are the scanned values of the jobs hash when they hold
+        # everything in selector, otherwise the jobs are fetched
+        STATES = 5
+        count = 0
         m = self.r.pipeline()
         for jobid in jobids:
-            m.hget(self.jobs_hash, jobid)
+            m.sismember(self.success_set, jobid)
+            m.sismember(self.failed_set, jobid)
+            m.sismember(self.cancelled_hash, jobid)
+            m.zscore(self.leases_set, jobid)
+            m.zscore(self.scheduled_set, jobid)
+            if configs is None:
+                count = self.store.fetch(m, jobid, selector)
         results = m.execute()
 
         jobs = []
-        for result in results:
-            job = json.loads(result)
+        for (i, jobid) in enumerate(jobids):
+            states = results[i * (STATES + count):(i + 1) * (STATES + count)]
+            (success, failed, cancelled, lease, run_at) = states[0:STATES]
+            if configs is None:
+                job = self.store.decode(states[STATES:], selector)
+            else:
+                job = json.loads(configs[jobid])
+            if cancelled or not job:
+                continue
             if 'metadata' in selector:
-                jobid = job['metadata']['jobid']
-                if jobid in success:
+                if success:
                     status = 'SUCCESS'
-                elif jobid in failed:
+                elif failed:
                     status = 'FAILED'
+                elif lease is not None:
+                    status = 'ACTIVE'
+                elif run_at is not None:
+                    status = 'SCHEDULED'
                 else:
-                    if jobid in pending:
-                        status = 'PENDING'
-                    else:
-                        status = 'ACTIVE'
+                    status = 'PENDING'
                 job['metadata']['status'] = status
 
             unwanted = set(job) - set(selector)
@@ -278,50 +892,61 @@ class RedisQueue():
 
         return jobs
 
-    def cancel(self, jobid):
-        # if it's active, there's not much to be done except if the job
-        # explicitly checks for cancellation?
+    def _retire(self, jobids):
         m = self.r.pipeline()
-        # we mark this as cancelled in case it's requeued
-        m.sadd(self.cancelled_hash, jobid)
-        # we fetch and delete from jobs key
-        m.hget(self.jobs_hash, jobid)
-        m.hdel(self.jobs_hash, jobid)
-        # we delete from whatever start or end states we can
-        m.srem(self.success_set, jobid)
-        m.hdel(self.failed_set, jobid)
-        m.hdel(self.ongoing_hash, jobid)
+        count = 0
+        for jobid in jobids:
+            m.sismember(self.success_set, jobid)
+            m.sismember(self.failed_set, jobid)
+            count = self.store.fetch(m, jobid)
         results = m.execute()
-        return json.loads(results[1])
 
-    def step(self, jobid, stepname):
-        self.active_worker()
-        self.active_job(jobid)
-        return self.r.hset(self.step_hash, jobid, stepname)
+        jobs = []
+        for (i, jobid) in enumerate(jobids):
+            states = results[i * (2 + count):(i + 1) * (2 + count)]
+            job = self.store.decode(states[2:])
+            if not job:
+                # cancelled, nothing left to archive
+                continue
+            if states[0]:
+                job['metadata']['status'] = 'SUCCESS'
+            elif states[1]:
+                job['metadata']['status'] = 'FAILED'
+            else:
+                job['metadata']['status'] = 'UNKNOWN'
+            jobs.append((jobid, job))
+        if self.archive and jobs:
+            self.archive.append(jobs)
 
-    def _finalize(self, jobid, key, current):
         m = self.r.pipeline()
-        m.sadd(key, jobid)
-        m.hdel(self.current_hash, self.client_id)
-        m.hdel(self.ongoing_hash, jobid)
-        m.hset(self.jobs_hash, jobid, json.dumps(current))
-        m.hdel(self.step_hash, jobid)
+        for jobid in jobids:
+            self.store.delete(m, jobid)
+            m.srem(self.success_set, jobid)
+            m.srem(self.failed_set, jobid)
+            m.srem(self.cancelled_hash, jobid)
+            m.zrem(self.finished_set, jobid)
         m.execute()
 
-    def _get_current_job(self):
+    def _get_current_jobid(self):
         jobid = self.r.hget(self.current_hash, self.client_id)
         if not jobid:
             raise QueueException('Finish called with no current task')
-        current_json = self.r.hget(self.jobs_hash, jobid)
-        current = json.loads(current_json)
-        return (jobid, current)
+        return jobid
 
-    def _worker_info(self, last, workerid, timeout=60):
-        (hostname, pid, seconds, millis) = workerid.split('.')
+    def _worker_info(self, last, workerid, jobid=None, step=None,
+                     expiry=None, timeout=60):
+        # hostname may contain dots, pid may be followed by -slot
+        parts = workerid.split('.')
+        hostname = '.'.join(parts[:-3])
+        (pid, seconds, millis) = parts[-3:]
+        (pid, separator, slot) = pid.partition('-')
         started = float('%s.%s' % (seconds, millis))
         now = time.time()
         last_update = now - last
-        jobid = self.r.hget(self.current_hash, self.client_id)
+        lease_age = None
+        if expiry is not None:
+            # seconds since the lease was last renewed
+            lease_age = now - (float(expiry) - self.lease_timeout)
         if last_update > timeout:
             status = 'STALE'
         else:
@@ -336,7 +961,10 @@ class RedisQueue():
             'started': unix_to_iso8601(started),
             'hostname': hostname,
             'pid': pid,
+            'slot': slot or None,
             'jobid': jobid,
+            'step': step,
+            'lease_age': lease_age,
             'status': status
         }
 
@@ -349,53 +977,112 @@ class RedisQueue():
 
 
 class QueueManager():
-    def __init__(self,  config, redisclient):
+    def __init__(self,  config, redisclient, slot=None):
         self.queues = {}
+        self.slot = slot
         self.config = config
         self.r = redisclient
         self.pending_list = []
         self.pending_key_to_queue = {}
+        self.queue_list = []
         self.last_queue = None  # mostly for operations on workers
+        self.dequeue_script = self.r.register_script(
+            sparqueue.scripts.DEQUEUE)
+        # smooth weighted round robin across queues
+        self.weights = {}
+        self.credits = {}
 
     def pop(self, timeout=3):
         # block pop with catchable exception
         if not self.pending_list:
             raise QueueDoesNotExistException('Not queues configured')
-        self.last_queue.active_worker()
-        retvalue = self.r.brpop(self.pending_list, timeout=timeout)
+        order = self._order()
+        retvalue = self._dequeue(order)
+        if retvalue:
+            self._served(retvalue[0])
+            return retvalue
+        # blocks only when every queue is empty; only a wakeup token is
+        # popped while blocking, the job is popped and leased by the dequeue
+        # script so a worker dying in between leaves it in its lane
+        self.r.brpop(
+            [queue.wakeup_list for queue in order], timeout=timeout)
+        retvalue = self._dequeue(order)
         if not retvalue:
             raise QueueTimeoutException(
                 'brpop returned null for %s due to timeout - please retry' % (
                     self.pending_list))
-        (key, jobid) = retvalue
+        self._served(retvalue[0])
+        return retvalue
+
+    def _order(self):
+        # queues by decreasing credit once they earn their weight, within
+        # a queue the lanes go by priority
+        credits = dict(
+            (queue, self.credits[queue] + self.weights[queue])
+            for queue in self.queue_list)
+        return sorted(self.queue_list, key=lambda queue: -credits[queue])
+
+    def _served(self, served):
+        # every queue earns its weight, the one served pays the total;
+        # credit is kept within [-total, total] so that neither a queue that
+        # was idle nor one served alone meanwhile gets a long burst
+        total = sum(self.weights.values())
+        for queue in self.queue_list:
+            self.credits[queue] = min(
+                self.credits[queue] + self.weights[queue], total)
+        self.credits[served] = max(self.credits[served] - total, -total)
+
+    def _dequeue(self, order):
+        # single round trip: pops from the first non-empty pending list,
+        # skips cancelled jobs and activates the job for the worker
+        keys = []
+        args = [time.time()]
+        for queue in order:
+            for lane in queue.lanes:
+                keys.extend(queue.dequeue_keys(lane))
+                args.extend(queue.activate_args())
+        retvalue = self.dequeue_script(keys=keys, args=args)
+        if not retvalue:
+            return None
+        (key, jobid, config) = retvalue
         queue = self.pending_key_to_queue[key]
-
-        return (queue, queue.activate_job(jobid))
+        return (queue, queue.store.decode_script(config))
 
     def requeue(self):
         requeued = []
-        for (key, queue) in self.pending_key_to_queue.iteritems():
+        for queue in self.queue_list:
             requeued.extend(queue.requeue())
         return requeued
 
+    def promote(self):
+        promoted = 0
+        for queue in self.queue_list:
+            promoted = promoted + queue.promote()
+        return promoted
+
     def add_list(self, queues):
         for queue in queues:
             system_name = queue['system']
             queue_name = queue['queue']
-            queue = self.add(system_name, queue_name)
+            queue = self.add(system_name, queue_name, queue.get('weight', 1))
 
-    def add(self, system_name, queue_name):
+    def add(self, system_name, queue_name, weight=1):
         queue = RedisQueue(
             self.r,
             system_name,
             queue_name,
-            self.config)
+            self.config,
+            slot=self.slot)
         if system_name not in self.queues:
             self.queues[system_name] = {}
 
         self.queues[system_name][queue_name] = queue
-        self.pending_list.append(queue.pending_list)
-        self.pending_key_to_queue[queue.pending_list] = queue
+        for lane in queue.lanes:
+            self.pending_list.append(lane)
+            self.pending_key_to_queue[lane] = queue
+        self.queue_list.append(queue)
+        self.weights[queue] = weight
+        self.credits[queue] = 0
         self.last_queue = queue
         return queue
 
@@ -407,7 +1094,7 @@ class QueueManager():
 
     def exit(self):
         queue_names = []
-        for (key, queue) in self.pending_key_to_queue.iteritems():
+        for queue in self.queue_list:
             queue.exit()
             queue_names.append(queue.queue_name)
         return queue_names
@@ -0,0 +1,109 @@
+from __future__ import absolute_import
+
+import os
+import redis
+import socket
+import time
+import uuid
+
+import sparqueue.config
+import sparqueue.logging
+import sparqueue.queue
+import sparqueue.redis
+import sparqueue.scripts
+
+RUN = True
+
+logger = sparqueue.logging.getLogger(__file__)
+
+
+def stop():
+    global RUN
+    logger.info('EXIT REQUESTED, FINISHING LOOP')
+
+    RUN = False
+
+
+def execute(config_filename):
+    config = sparqueue.config.get_config(config_filename)
+
+    while RUN:
+        try:
+            loop(config)
+        except redis.exceptions.ConnectionError, e:
+            logger.error('Error connecting: ' + str(e))
+            time.sleep(5)
+
+
+def loop(config):
+    redisclient = sparqueue.redis.client(config)
+    queue_manager = sparqueue.queue.QueueManager(config, redisclient)
+    queue_manager.add_list(config['queues'])
+    reaper = Reaper(redisclient, queue_manager, config)
+
+    try:
+        while RUN:
+            reaper.reap()
+            time.sleep(config.get('interval', 1))
+    finally:
+        reaper.release()
+
+
+class Leader():
+    # lease-based lock: held while renewed within ttl seconds
+    def __init__(self, r, key, ttl):
+        self.r = r
+        self.key = key
+        self.ttl = int(ttl * 1000)
+        self.token = '%s.%s.%s' % (
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        self.renew_script = self.r.register_script(
+            sparqueue.scripts.RENEW_LOCK)
+        self.release_script = self.r.register_script(
+            sparqueue.scripts.RELEASE_LOCK)
+
+    def acquire(self):
+        # acquires or renews the lock, returns whether we are the leader
+        if self.r.set(self.key, self.token, px=self.ttl, nx=True):
+            logger.info('leader for %s' % self.key)
+            return True
+        return bool(self.renew_script(
+            keys=[self.key], args=[self.token, self.ttl]))
+
+    def release(self):
+        return bool(self.release_script(keys=[self.key], args=[self.token]))
+
+
+class Reaper():
+    # requeues expired leases, promotes due scheduled jobs and removes
+    # stale workers for the systems
+    # it is the leader of, only one reaper per system is active at a time
+    def __init__(self, redisclient, queue_manager, config):
+        self.queue_manager = queue_manager
+        # seconds without activity before a worker is removed
+        self.stale_timeout = config.get('stale_timeout', 60)
+        self.leaders = {}
+        for (system, queues) in queue_manager.queues.iteritems():
+            queue = queues.values()[0]
+            self.leaders[system] = Leader(
+                redisclient, queue.prefix('reaper'),
+                config.get('lock_ttl', 10))
+
+    def reap(self):
+        for (system, queues) in self.queue_manager.queues.iteritems():
+            if not self.leaders[system].acquire():
+                continue
+            for queue in queues.values():
+                requeued = queue.requeue()
+                if requeued:
+                    logger.info('requeued %s' % ','.join(requeued))
+                promoted = queue.promote()
+                if promoted:
+                    logger.info('promoted %s scheduled jobs' % promoted)
+                stale = queue.reap_workers(self.stale_timeout)
+                if stale:
+                    logger.info('removed stale workers %s' % ','.join(stale))
+
+    def release(self):
+        for leader in self.leaders.values():
+            leader.release()
@@ -3,15 +3,22 @@ import redis
 import os
 
 
-def client(config=None):
+def client(config=None, max_connections=None, timeout=5):
     #print dir(redis)
+    kwargs = {}
     if config and 'redis' in config:
         redis_config = config['redis']
         print 'Using alternate Redis config %s' % (redis_config)
-        return redis.Redis(
-            host=redis_config['host'],
-            port=int(redis_config['port']))
-    return redis.Redis()
+        kwargs = {
+            'host': redis_config['host'],
+            'port': int(redis_config['port'])}
+    if max_connections:
+        # shared by the threads of a process, waits at most timeout seconds
+        # for a free connection
+        pool = redis.BlockingConnectionPool(
+            max_connections=max_connections, timeout=timeout, **kwargs)
+        return redis.Redis(connection_pool=pool)
+    return redis.Redis(**kwargs)
 
 #print 'Python Redis version %s' % redis.__version__
 
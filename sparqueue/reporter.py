@@ -1,26 +1,81 @@
+import cProfile
+import pstats
+import threading
 import time
+import traceback
 
 import resource
 
+# getrusage fields reported as deltas over a job and each of its steps, the
+# blocks are 512 bytes and ru_maxrss is in kilobytes on Linux
+RUSAGE_FIELDS = [
+    ('ru_utime', 'cpu_user'),
+    ('ru_stime', 'cpu_system'),
+    ('ru_maxrss', 'maxrss_growth_kb'),
+    ('ru_inblock', 'blocks_in'),
+    ('ru_oublock', 'blocks_out'),
+    ('ru_nvcsw', 'voluntary_switches'),
+    ('ru_nivcsw', 'involuntary_switches'),
+]
+
+# functions kept in the profile summary of a job, by cumulative time
+PROFILE_LIMIT = 20
+
+
+def usage_delta(start, stop):
+    # the process is measured, so the deltas include the jobs of the other
+    # slots of the worker when it runs several
+    return dict(
+        (name, getattr(stop, field) - getattr(start, field))
+        for (field, name) in RUSAGE_FIELDS)
+
+
+def profile_summary(profiler, limit=PROFILE_LIMIT):
+    # the limit functions with the highest cumulative time, as
+    # [{"function": "file:line(name)", "calls", "time", "cumulative"}]
+    functions = pstats.Stats(profiler).strip_dirs().stats
+    summary = []
+    for (function, (primitive, calls, time_, cumulative, callers)) in sorted(
+            functions.iteritems(), key=lambda item: -item[1][3])[:limit]:
+        summary.append({
+            'function': pstats.func_std_string(function),
+            'calls': calls,
+            'time': time_,
+            'cumulative': cumulative})
+    return summary
+
 
 class Reporter():
-    def __init__(self, logger, queue, jobid):
+    # keeps the step and progress of a job, written to its queue by the
+    # flusher if given (at most once per flusher interval) and right away
+    # otherwise
+    def __init__(self, logger, queue, jobid, flusher=None):
         self.jobid = jobid
         self.queue = queue
         self.warning = logger.warning
         self.info = logger.info
         self.start_time = time.time()
         self.start_resources = resource.getrusage(resource.RUSAGE_SELF)
+        self.flusher = flusher
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.percent = None
+        self.profile_summary = None
 
         self.steps = []
+        if flusher:
+            flusher.add(self)
 
     def record_step(self):
+        self.step_stop_time = time.time()
+        step_stop_resources = resource.getrusage(resource.RUSAGE_SELF)
         self.steps.append({
             'step': self.stepname,
             'start_time': self.step_start_time,
             'stop_time': self.step_stop_time,
             'elapsed': self.step_stop_time - self.step_start_time,
-            #'resources': list(resource.getrusage(resource.RUSAGE_SELF))
+            'resources': usage_delta(
+                self.step_start_resources, step_stop_resources),
         })
 
     def step(self, step, count=1):
@@ -28,27 +83,75 @@ class Reporter():
             self.increment()
 
         if hasattr(self, 'stepname'):
-            self.step_stop_time = time.time()
             self.record_step()
 
         self.step_start_time = time.time()
+        self.step_start_resources = resource.getrusage(resource.RUSAGE_SELF)
         assert count > 0
-        self.stepname = step
-        self.info('Step %s' % self.stepname)
+        self.info('Step %s' % step)
         if count > 1:
             self.info('Expecting %s sub-steps' % count)
-        self.total = count
-        self.count = count
-        self.queue.step(self.jobid, step)
+        with self.lock:
+            self.stepname = step
+            self.total = count
+            self.count = count
+            self.percent = 0.0 if count > 1 else None
+            self.dirty = True
+        if not self.flusher:
+            self.flush()
 
     def increment(self):
-        progress = 100-int((float(self.count)/float(self.total))*100)
-        self.info('%s Progress: %s' % (self.stepname, progress))
-        self.count = self.count - 1
+        with self.lock:
+            self.count = max(self.count - 1, 0)
+            self.percent = 100.0 * (self.total - self.count) / self.total
+            self.dirty = True
+        self.info('%s Progress: %d' % (self.stepname, self.percent))
+        if not self.flusher:
+            self.flush()
+
+    def progress(self, percent):
+        # percent done of the current step, set by the job itself
+        with self.lock:
+            self.percent = float(percent)
+            self.dirty = True
+        if not self.flusher:
+            self.flush()
+
+    def flush(self, m=None):
+        # writes the latest step and progress if they changed, in pipeline
+        # m if given
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            stepname = getattr(self, 'stepname', '')
+            percent = self.percent
+        if m is None:
+            self.queue.step(self.jobid, stepname, percent)
+        else:
+            self.queue.report(m, self.jobid, stepname, percent)
+
+    def close(self):
+        # final flush, nothing is written for the job afterwards
+        if self.flusher:
+            self.flusher.remove(self)
+        self.flush()
+
+    def profile(self, function, *args, **kwargs):
+        # calls function under cProfile and keeps the summary for stats
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(function, *args, **kwargs)
+        finally:
+            self.profile_summary = profile_summary(profiler)
 
     def finish(self):
         self.info('Job Completed')
+        if hasattr(self, 'stepname'):
+            self.record_step()
         self.stop_time = time.time()
+        self.stop_resources = resource.getrusage(resource.RUSAGE_SELF)
+        self.close()
 
     def stats(self):
         stats = {}
@@ -56,5 +159,51 @@ class Reporter():
         stats['stop_time'] = self.stop_time
         stats['elapsed'] = self.stop_time - self.start_time
         stats['steps'] = self.steps
-        stats['resources'] = list(self.start_resources)
+        stats['resources'] = usage_delta(
+            self.start_resources, self.stop_resources)
+        if self.profile_summary is not None:
+            stats['profile'] = self.profile_summary
         return stats
+
+
+class Flusher(threading.Thread):
+    # writes the step and progress changes of the registered reporters
+    # every interval seconds, in one pipeline
+    def __init__(self, redisclient, logger, interval=0.5):
+        threading.Thread.__init__(self, name='flusher')
+        self.daemon = True
+        self.r = redisclient
+        self.logger = logger
+        self.interval = interval
+        # held while flushing so that a removed reporter is never written
+        # after its job is finalized
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.reporters = set()
+
+    def add(self, reporter):
+        with self.lock:
+            self.reporters.add(reporter)
+
+    def remove(self, reporter):
+        with self.lock:
+            self.reporters.discard(reporter)
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception, e:
+                self.logger.error('problem flushing progress: %s' % (
+                    traceback.format_exc(e)))
+
+    def flush(self):
+        with self.lock:
+            m = self.r.pipeline(transaction=False)
+            for reporter in self.reporters:
+                reporter.flush(m)
+            if m.command_stack:
+                m.execute()
@@ -0,0 +1,99 @@
+from __future__ import absolute_import
+
+import json
+import os
+import signal
+import subprocess
+import sys
+import traceback
+
+import sparqueue.loader
+import sparqueue.logging
+import sparqueue.queue
+import sparqueue.redis
+import sparqueue.reporter
+
+logger = sparqueue.logging.getLogger(__file__)
+
+
+class RunnerException(Exception):
+    pass
+
+
+def run(config, queue, job, path):
+    # performs job of queue in a child process whose imports come from the
+    # environment directory path before the worker's own, so that the jobs
+    # of different environments never share modules; returns (output,
+    # stats) and raises RunnerException when the job fails
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [path] + [p for p in sys.path if p])
+    # the log files are the worker's, the child logs to stderr
+    env['SPARQUEUE_LOG_FILES'] = '0'
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'sparqueue.runner'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+    out = process.communicate(json.dumps({
+        'config': config,
+        'client_id': queue.client_id,
+        'job': job}))[0]
+    try:
+        result = json.loads(out)
+    except ValueError:
+        raise RunnerException(
+            'job process exited with %s' % process.returncode)
+    if 'error' in result:
+        logger.error('problem processing %s in %s: %s' % (
+            job['metadata']['jobid'], path, result['traceback']))
+        raise RunnerException(result['error'])
+    return (result['output'], result['stats'])
+
+
+def main():
+    # the worker finishes the job it is running when interrupted
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # what the job prints goes to stderr, stdout carries the result
+    result_file = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+
+    request = json.load(sys.stdin)
+    config = request['config']
+    job = request['job']
+    metadata = job['metadata']
+    r = sparqueue.redis.client(config)
+    queue = sparqueue.queue.RedisQueue(
+        r, metadata['system'], metadata['queue'], config)
+    # the job is reported as the worker's, not as a worker of its own
+    queue.client_id = request['client_id']
+    flusher = None
+    if config.get('progress_interval', 500):
+        flusher = sparqueue.reporter.Flusher(
+            r, logger, config.get('progress_interval', 500) / 1000.0)
+        flusher.start()
+    reporter = sparqueue.reporter.Reporter(
+        logger, queue, metadata['jobid'], flusher)
+    try:
+        instance = sparqueue.loader.JobLoader(None).getInstance(
+            job['class'], config)
+        job['vars']['reporter'] = reporter
+        if metadata.get('profile'):
+            output = reporter.profile(instance.perform, **job['vars'])
+        else:
+            output = instance.perform(**job['vars'])
+        reporter.finish()
+        result = json.dumps({'output': output, 'stats': reporter.stats()})
+    except Exception, e:
+        reporter.close()
+        result = json.dumps({
+            'error': '%s: %s' % (e.__class__.__name__, e),
+            'traceback': traceback.format_exc(e)})
+    finally:
+        if flusher:
+            flusher.stop()
+            flusher.join()
+    result_file.write(result)
+    result_file.close()
+
+
+if __name__ == '__main__':
+    main()
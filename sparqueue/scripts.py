@@ -0,0 +1,275 @@
+"""Lua sources for the server-side scripts used by sparqueue.queue.
+
+Scripts are registered on the Redis client with register_script so they
+are sent once and afterwards invoked by their SHA.
+"""
+
+# keys and arguments for a queue in the order expected by the
+# activation scripts
+ACTIVATE_KEYS = 8
+ACTIVATE_ARGS = 6
+
+# upper bounds in seconds of the buckets of the wait and run time
+# histograms, the last bucket is +Inf
+HISTOGRAM_BUCKETS = [
+    0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, 14400]
+
+# most tokens kept on the wakeup list of a queue, enough for the workers
+# blocked on it
+WAKEUP_TOKENS = 100
+
+# job state change events, channel is empty when they are disabled
+PUBLISH_FUNCTION = """
+local function publish(channel, system, queue, jobid, state, now)
+    if channel ~= '' then
+        redis.call('PUBLISH', channel, cjson.encode({
+            system=system, queue=queue, jobid=jobid, state=state,
+            time=tonumber(now)}))
+    end
+end
+"""
+
+# tokens waking the workers blocked on the wakeup list of a queue, the
+# jobs themselves are only popped by DEQUEUE
+WAKE_FUNCTION = """
+local function wake(wakeup, count)
+    for i = 1, math.min(count, %(tokens)d) do
+        redis.call('LPUSH', wakeup, 1)
+    end
+    redis.call('LTRIM', wakeup, 0, %(tokens)d - 1)
+end
+""" % {'tokens': WAKEUP_TOKENS}
+
+# histogram hash of bucket => count with the sum and count of the values
+OBSERVE_FUNCTION = """
+local buckets = {%s}
+local function observe(histogram, value)
+    local bucket = '+Inf'
+    for i, bound in ipairs(buckets) do
+        if value <= tonumber(bound) then
+            bucket = bound
+            break
+        end
+    end
+    redis.call('HINCRBY', histogram, bucket, 1)
+    redis.call('HINCRBYFLOAT', histogram, 'sum', value)
+    redis.call('HINCRBY', histogram, 'count', 1)
+end
+""" % ', '.join("'%g'" % bound for bound in HISTOGRAM_BUCKETS)
+
+# keys from offset: pending, cancelled, ongoing, activity, current, jobs,
+# leases, wait histogram
+# args from base: client_id, lease expiry, job prefix, events channel,
+# system, queue
+ACTIVATE_FUNCTION = PUBLISH_FUNCTION + OBSERVE_FUNCTION + """
+local function activate(keys, offset, args, base, jobid, now)
+    local cancelled = keys[offset + 2]
+    local ongoing = keys[offset + 3]
+    local current = keys[offset + 5]
+    local jobs = keys[offset + 6]
+    local leases = keys[offset + 7]
+    local waits = keys[offset + 8]
+    local prefix = args[base + 2]
+    if redis.call('SISMEMBER', cancelled, jobid) == 1 then
+        return false
+    end
+    local config = redis.call('HGET', jobs, jobid)
+    if not config then
+        return false
+    end
+    if prefix ~= '' then
+        -- the job hash of sparqueue.store.HashStore
+        config = {config, redis.call('HGETALL', prefix .. jobid)}
+    end
+    -- the time it was pushed, requeued or promoted
+    local queued = redis.call('HGET', ongoing, jobid)
+    if queued then
+        observe(waits, math.max(0, tonumber(now) - tonumber(queued)))
+    end
+    redis.call('HSET', ongoing, jobid, now)
+    redis.call('ZADD', leases, args[base + 1], jobid)
+    redis.call('HSET', current, args[base], jobid)
+    publish(args[base + 3], args[base + 4], args[base + 5], jobid, 'ACTIVE',
+            now)
+    return config
+end
+"""
+
+# KEYS: ACTIVATE_KEYS per queue lane, in the order they are tried
+# ARGV: now, then ACTIVATE_ARGS per queue lane
+# returns {pending, jobid, config} or nil when every lane is empty
+DEQUEUE = ACTIVATE_FUNCTION + """
+local now = ARGV[1]
+for offset = 0, #KEYS - 1, %(keys)d do
+    local base = offset / %(keys)d * %(args)d + 2
+    redis.call('HSET', KEYS[offset + 4], ARGV[base], now)
+end
+for offset = 0, #KEYS - 1, %(keys)d do
+    local base = offset / %(keys)d * %(args)d + 2
+    local pending = KEYS[offset + 1]
+    while true do
+        local jobid = redis.call('RPOP', pending)
+        if not jobid then
+            break
+        end
+        local config = activate(KEYS, offset, ARGV, base, jobid, now)
+        if config then
+            return {pending, jobid, config}
+        end
+    end
+end
+return false
+""" % {'keys': ACTIVATE_KEYS, 'args': ACTIVATE_ARGS}
+
+# KEYS: ACTIVATE_KEYS for the queue of the job
+# ARGV: now, jobid, then ACTIVATE_ARGS for the queue
+# returns the job config or nil when cancelled
+ACTIVATE = ACTIVATE_FUNCTION + """
+redis.call('HSET', KEYS[4], ARGV[3], ARGV[1])
+return activate(KEYS, 0, ARGV, 3, ARGV[2], ARGV[1])
+"""
+
+# the lane of a job from the metadata in the jobs hash, both stores keep
+# the metadata there
+LANE_FUNCTION = """
+local function lane(jobs, jobid, high, normal, low)
+    local config = redis.call('HGET', jobs, jobid)
+    if not config then
+        return nil
+    end
+    local priority = cjson.decode(config)['metadata']['priority']
+    if priority == 'high' then
+        return high
+    elseif priority == 'low' then
+        return low
+    end
+    return normal
+end
+"""
+
+# KEYS: leases, cancelled, ongoing, jobs, high, normal and low lanes,
+# wakeup
+# ARGV: now, batch, events channel, system, queue
+# moves at most batch jobs whose lease expired back to their lane
+# and returns their jobids
+REQUEUE = PUBLISH_FUNCTION + LANE_FUNCTION + WAKE_FUNCTION + """
+local jobids = redis.call(
+    'ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+local requeued = {}
+for i, jobid in ipairs(jobids) do
+    redis.call('ZREM', KEYS[1], jobid)
+    if redis.call('SISMEMBER', KEYS[2], jobid) == 0 then
+        local pending = lane(KEYS[4], jobid, KEYS[5], KEYS[6], KEYS[7])
+        if pending then
+            redis.call('LPUSH', pending, jobid)
+            redis.call('HSET', KEYS[3], jobid, ARGV[1])
+            publish(ARGV[3], ARGV[4], ARGV[5], jobid, 'PENDING', ARGV[1])
+            table.insert(requeued, jobid)
+        end
+    end
+end
+wake(KEYS[8], #requeued)
+return {#jobids, requeued}
+"""
+
+# KEYS: lock
+# ARGV: token, ttl in milliseconds
+# extends the lock if it is still held by token
+RENEW_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS: lock
+# ARGV: token
+# deletes the lock if it is still held by token
+RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# KEYS: scheduled, ongoing, jobs, high, normal and low lanes, wakeup
+# ARGV: now, batch, events channel, system, queue
+# moves at most batch due jobs to their lane, returns how many were due
+PROMOTE = PUBLISH_FUNCTION + LANE_FUNCTION + WAKE_FUNCTION + """
+local jobids = redis.call(
+    'ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for i, jobid in ipairs(jobids) do
+    redis.call('ZREM', KEYS[1], jobid)
+    local pending = lane(KEYS[3], jobid, KEYS[4], KEYS[5], KEYS[6])
+    if pending then
+        redis.call('LPUSH', pending, jobid)
+        redis.call('HSET', KEYS[2], jobid, ARGV[1])
+        publish(ARGV[3], ARGV[4], ARGV[5], jobid, 'PENDING', ARGV[1])
+    end
+end
+wake(KEYS[7], #jobids)
+return #jobids
+"""
+
+# KEYS: activity, current, step, leases
+# returns workerid, last activity, jobid, step and lease expiry of every
+# worker of the queue, false when they have none
+WORKERS = """
+local activity = redis.call('HGETALL', KEYS[1])
+local workers = {}
+for i = 1, #activity, 2 do
+    local jobid = redis.call('HGET', KEYS[2], activity[i])
+    local step = false
+    local expiry = false
+    if jobid then
+        step = redis.call('HGET', KEYS[3], jobid)
+        expiry = redis.call('ZSCORE', KEYS[4], jobid)
+    end
+    table.insert(workers, activity[i])
+    table.insert(workers, activity[i + 1])
+    table.insert(workers, jobid)
+    table.insert(workers, step)
+    table.insert(workers, expiry)
+end
+return workers
+"""
+
+# KEYS: incoming, processing list, consumers
+# ARGV: count, consumer, now, stale time, processing list prefix
+# moves the jobs of the consumers stale since before the stale time back to
+# the incoming list, renews the consumer and moves jobs from the incoming to
+# its processing list until it holds count, returns them newest first
+INCOMING_TAKE = """
+local stale = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[4])
+for i, consumer in ipairs(stale) do
+    local processing = ARGV[5] .. consumer
+    while true do
+        -- the oldest job is pushed last, so it is the next one taken
+        local value = redis.call('LPOP', processing)
+        if not value then
+            break
+        end
+        redis.call('RPUSH', KEYS[1], value)
+    end
+    redis.call('ZREM', KEYS[3], consumer)
+end
+redis.call('ZADD', KEYS[3], ARGV[3], ARGV[2])
+for i = redis.call('LLEN', KEYS[2]) + 1, tonumber(ARGV[1]) do
+    if not redis.call('RPOPLPUSH', KEYS[1], KEYS[2]) then
+        break
+    end
+end
+return redis.call('LRANGE', KEYS[2], 0, -1)
+"""
+
+# KEYS: ongoing, run histogram, counters of the minute
+# ARGV: jobid, now, counter, ttl of the counters
+# records the run time of jobid before it is finalized
+FINISH = OBSERVE_FUNCTION + """
+local started = redis.call('HGET', KEYS[1], ARGV[1])
+if started then
+    observe(KEYS[2], math.max(0, tonumber(ARGV[2]) - tonumber(started)))
+end
+redis.call('HINCRBY', KEYS[3], ARGV[3], 1)
+redis.call('EXPIRE', KEYS[3], ARGV[4])
+"""
@@ -0,0 +1,238 @@
+from __future__ import absolute_import
+
+import Queue
+import socket
+import threading
+import wsgiref.simple_server
+import zlib
+
+import bottle
+
+# sent to the connections refused when every thread is busy and the backlog
+# is full
+BUSY_RESPONSE = (
+    'HTTP/1.0 503 Service Unavailable\r\n'
+    'Content-Length: 0\r\n'
+    'Connection: close\r\n\r\n')
+
+
+class GzipMiddleware():
+    # compresses the responses for the clients accepting gzip, except the
+    # event streams and the responses under minimum_size bytes
+    def __init__(self, app, minimum_size=1024, level=6):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+
+    def __call__(self, environ, start_response):
+        if ('gzip' not in environ.get('HTTP_ACCEPT_ENCODING', '') or
+                environ['REQUEST_METHOD'] == 'HEAD'):
+            return self.app(environ, start_response)
+        started = []
+
+        def delayed_start_response(status, headers, exc_info=None):
+            started[:] = [status, headers, exc_info]
+            return None
+
+        result = self.app(environ, delayed_start_response)
+        (status, headers, exc_info) = started
+        names = dict((name.lower(), value) for (name, value) in headers)
+        length = names.get('content-length')
+        content_type = names.get('content-type', '')
+        if ('content-encoding' in names or
+                content_type.startswith('text/event-stream') or
+                (length is not None and int(length) < self.minimum_size)):
+            start_response(status, headers, exc_info)
+            return result
+        headers = [
+            (name, value) for (name, value) in headers
+            if name.lower() != 'content-length']
+        headers.append(('Content-Encoding', 'gzip'))
+        headers.append(('Vary', 'Accept-Encoding'))
+        if length is None:
+            # streamed, so is the compression
+            start_response(status, headers, exc_info)
+            return self.compress(result)
+        data = ''.join(self.compress(result))
+        headers.append(('Content-Length', str(len(data))))
+        start_response(status, headers, exc_info)
+        return [data]
+
+    def compress(self, result):
+        compressor = zlib.compressobj(
+            self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        try:
+            for data in result:
+                data = compressor.compress(data)
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+class RequestBody():
+    # the wsgi.input of a keep-alive request, reads at most its
+    # Content-Length so that the next request is left in the stream
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size)
+        self.remaining = self.remaining - len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.readline(size)
+        self.remaining = self.remaining - len(data)
+        return data
+
+    def readlines(self, hint=None):
+        return list(iter(self.readline, ''))
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def drain(self):
+        while self.remaining > 0 and self.read(64 * 1024):
+            pass
+
+
+class KeepAliveServerHandler(wsgiref.simple_server.ServerHandler):
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        wsgiref.simple_server.ServerHandler.cleanup_headers(self)
+        if 'Content-Length' not in self.headers:
+            # streamed responses end when the connection is closed
+            self.request_handler.close_connection = 1
+        if self.request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+
+
+class KeepAliveRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+    # serves the requests of a connection until the client closes it, asks
+    # for it or goes idle for keepalive_timeout seconds
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        # no reverse DNS lookup
+        return self.client_address[0]
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_request()
+        while not self.close_connection:
+            self.connection.settimeout(self.server.keepalive_timeout)
+            try:
+                self.raw_requestline = self.rfile.readline(65537)
+            except socket.timeout:
+                return
+            self.connection.settimeout(self.server.request_timeout)
+            self.handle_request(self.raw_requestline)
+
+    def handle_request(self, requestline=None):
+        if requestline is None:
+            requestline = self.rfile.readline(65537)
+        self.raw_requestline = requestline
+        if not requestline:
+            self.close_connection = 1
+            return
+        if len(requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = 1
+            return
+        if not self.parse_request():
+            return
+
+        length = self.headers.getheader('content-length')
+        if self.headers.getheader('transfer-encoding'):
+            # chunked bodies are read by the application until the end
+            body = self.rfile
+            self.close_connection = 1
+        else:
+            body = RequestBody(self.rfile, int(length or 0))
+        handler = KeepAliveServerHandler(
+            body, self.wfile, self.get_stderr(), self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        if not self.close_connection:
+            # whatever the application didn't read of the body
+            body.drain()
+
+
+class ThreadPoolWSGIServer(wsgiref.simple_server.WSGIServer):
+    # hands the accepted connections to a fixed pool of threads, at most
+    # backlog connections wait for a thread and the others are refused
+    threads = 32
+    backlog = 128
+    # seconds a connection may block on a read or a write
+    request_timeout = 30
+    # seconds an idle keep-alive connection is kept
+    keepalive_timeout = 5
+
+    def server_activate(self):
+        wsgiref.simple_server.WSGIServer.server_activate(self)
+        self.connections = Queue.Queue(self.backlog)
+        for i in xrange(self.threads):
+            thread = threading.Thread(
+                target=self.serve_connections, name='api-%s' % i)
+            thread.daemon = True
+            thread.start()
+
+    def process_request(self, request, client_address):
+        try:
+            self.connections.put_nowait((request, client_address))
+        except Queue.Full:
+            try:
+                request.sendall(BUSY_RESPONSE)
+            except Exception:
+                pass
+            self.shutdown_request(request)
+
+    def serve_connections(self):
+        while True:
+            (request, client_address) = self.connections.get()
+            try:
+                request.settimeout(self.request_timeout)
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+def server_class(threads=32, backlog=128, request_timeout=30,
+                 keepalive_timeout=5):
+    # a ThreadPoolWSGIServer with these settings, for make_server
+    class Server(ThreadPoolWSGIServer):
+        pass
+    Server.threads = threads
+    Server.backlog = backlog
+    Server.request_queue_size = backlog
+    Server.request_timeout = request_timeout
+    Server.keepalive_timeout = keepalive_timeout
+    return Server
+
+
+class ThreadPoolServer(bottle.WSGIRefServer):
+    # bottle adapter for ThreadPoolWSGIServer and keep-alive connections:
+    # run(server=ThreadPoolServer, threads=..., backlog=...,
+    #     request_timeout=..., keepalive_timeout=...)
+    def __init__(self, host='127.0.0.1', port=8080, threads=32, backlog=128,
+                 request_timeout=30, keepalive_timeout=5, **options):
+        bottle.WSGIRefServer.__init__(
+            self, host, port,
+            server_class=server_class(
+                threads, backlog, request_timeout, keepalive_timeout),
+            handler_class=KeepAliveRequestHandler,
+            **options)
@@ -0,0 +1,175 @@
+import json
+
+# top-level job keys HashStore keeps in the jobs hash, every other key
+# (vars, output, stats, last_error, traceback...) is a field of the job's
+# own hash
+HEADER = set(['class', 'metadata'])
+
+
+class BlobStore():
+    # every job is one JSON document in the jobs hash
+    name = 'blob'
+
+    def __init__(self, r, jobs_hash, job_prefix):
+        self.r = r
+        self.jobs_hash = jobs_hash
+        # no job hash, tells the scripts to only read the jobs hash
+        self.job_prefix = ''
+
+    def complete(self, selector):
+        # the values of the jobs hash are enough for selector
+        return True
+
+    def save(self, m, jobid, config):
+        m.hset(self.jobs_hash, jobid, json.dumps(config))
+
+    def update(self, m, jobid, fields):
+        # returns False without queuing anything when jobid no longer exists
+        # (cancelled while active)
+        current = self.load(jobid)
+        if current is None:
+            return False
+        current.update(fields)
+        self.save(m, jobid, current)
+        return True
+
+    def delete(self, m, jobid):
+        m.hdel(self.jobs_hash, jobid)
+
+    def fetch(self, m, jobid, fields=None):
+        # queues the commands reading a job, returns how many were queued
+        m.hget(self.jobs_hash, jobid)
+        return 1
+
+    def decode(self, results, fields=None):
+        if not results[0]:
+            return None
+        return json.loads(results[0])
+
+    def decode_script(self, value):
+        return json.loads(value)
+
+    def load(self, jobid, fields=None):
+        m = self.r.pipeline()
+        self.fetch(m, jobid, fields)
+        return self.decode(m.execute(), fields)
+
+    def migrate(self, m, jobid, source):
+        # rewrites a job stored by source in this store
+        config = source.load(jobid)
+        if config is None:
+            return
+        source.delete(m, jobid)
+        self.save(m, jobid, config)
+
+
+class HashStore(BlobStore):
+    # the header of a job (class and metadata) is in the jobs hash, every
+    # other key is JSON encoded in a field of the job hash so that
+    # metadata reads and finalize don't touch vars or output
+    name = 'hash'
+
+    def __init__(self, r, jobs_hash, job_prefix):
+        self.r = r
+        self.jobs_hash = jobs_hash
+        self.job_prefix = job_prefix
+
+    def job_key(self, jobid):
+        return self.job_prefix + jobid
+
+    def complete(self, selector):
+        return set(selector) <= HEADER
+
+    def save(self, m, jobid, config):
+        (header, body) = self._split(config)
+        m.hset(self.jobs_hash, jobid, json.dumps(header))
+        if body:
+            m.hmset(self.job_key(jobid), body)
+
+    def update(self, m, jobid, fields):
+        (header, body) = self._split(fields)
+        current = self.r.hget(self.jobs_hash, jobid)
+        if current is None:
+            # a job hash written now would never be deleted
+            return False
+        if header:
+            current = json.loads(current)
+            current.update(header)
+            m.hset(self.jobs_hash, jobid, json.dumps(current))
+        if body:
+            m.hmset(self.job_key(jobid), body)
+        return True
+
+    def delete(self, m, jobid):
+        m.hdel(self.jobs_hash, jobid)
+        m.delete(self.job_key(jobid))
+
+    def fetch(self, m, jobid, fields=None):
+        m.hget(self.jobs_hash, jobid)
+        if fields is None:
+            m.hgetall(self.job_key(jobid))
+            return 2
+        body = self._body_fields(fields)
+        if body:
+            m.hmget(self.job_key(jobid), body)
+            return 2
+        return 1
+
+    def decode(self, results, fields=None):
+        if not results[0]:
+            return None
+        config = json.loads(results[0])
+        if len(results) > 1:
+            if fields is None:
+                body = results[1]
+            else:
+                body = dict(zip(self._body_fields(fields), results[1]))
+            self._merge(config, body)
+        return config
+
+    def decode_script(self, value):
+        (header, body) = value
+        config = json.loads(header)
+        self._merge(config, dict(zip(body[::2], body[1::2])))
+        return config
+
+    def _body_fields(self, fields):
+        return [field for field in fields if field not in HEADER]
+
+    def _merge(self, config, body):
+        for (field, value) in body.iteritems():
+            if value is not None:
+                config[field] = json.loads(value)
+
+    def _split(self, config):
+        header = {}
+        body = {}
+        for (key, value) in config.iteritems():
+            if key in HEADER:
+                header[key] = value
+            else:
+                body[key] = json.dumps(value)
+        return (header, body)
+
+
+STORES = {
+    BlobStore.name: BlobStore,
+    HashStore.name: HashStore,
+}
+
+
+def migrate(r, source, target, batch=500):
+    # moves every job from the source store to the target one, a job at a
+    # time in a transaction, workers should be stopped while migrating
+    migrated = 0
+    cursor = 0
+    while True:
+        (cursor, jobids) = r.hscan(source.jobs_hash, cursor, count=batch)
+        for jobid in jobids:
+            m = r.pipeline()
+            target.migrate(m, jobid, source)
+            m.execute()
+            migrated = migrated + 1
+        if not cursor:
+            break
+    return migrated
@@ -0,0 +1,106 @@
+from __future__ import absolute_import
+
+import errno
+import os
+import signal
+import time
+import traceback
+
+import sparqueue.logging
+import sparqueue.metrics
+import sparqueue.worker
+
+logger = sparqueue.logging.getLogger(__file__)
+
+# seconds a child has to live to be restarted right away
+MIN_UPTIME = 5
+
+
+def supervise(config, jobloader, environments):
+    # preloads the job classes then forks the worker processes so they
+    # share the imported modules copy-on-write, children that exit are
+    # replaced and children over max_rss_mb are asked to stop after their
+    # current job
+    for clazz in config.get('preload', []):
+        logger.info('preloading %s' % clazz)
+        jobloader.getClass(clazz)
+
+    processes = config['processes']
+    max_rss = config.get('max_rss_mb', 0) * 1024 * 1024
+    children = {}  # pid => start time
+    indexes = {}  # pid => process index, reused by its replacement
+    stopping = set()
+
+    while sparqueue.worker.RUN:
+        while len(children) < processes:
+            index = min(set(xrange(processes)) - set(indexes.values()))
+            pid = spawn(config, jobloader, environments, index)
+            children[pid] = time.time()
+            indexes[pid] = index
+
+        time.sleep(1)
+
+        for pid in exited(children):
+            if time.time() - children.pop(pid) < MIN_UPTIME:
+                # don't spin when the children can't start
+                time.sleep(MIN_UPTIME)
+            indexes.pop(pid)
+            stopping.discard(pid)
+
+        if max_rss:
+            for pid in children:
+                if pid not in stopping and sparqueue.metrics.rss(pid) > max_rss:
+                    logger.warning('worker %s over %s bytes, restarting' % (
+                        pid, max_rss))
+                    os.kill(pid, signal.SIGINT)
+                    stopping.add(pid)
+
+    logger.info('stopping %s workers' % len(children))
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGINT)
+        except OSError:
+            pass
+    for pid in children:
+        wait(pid)
+
+
+def spawn(config, jobloader, environments, index=0):
+    pid = os.fork()
+    if pid == 0:
+        # child: Redis connections are only created from here
+        status = 0
+        try:
+            sparqueue.worker.run(
+                dict(config, process=index), jobloader, environments)
+        except Exception, e:
+            logger.error('worker crashed: %s' % traceback.format_exc(e))
+            status = 1
+        os._exit(status)
+    logger.info('started worker %s' % pid)
+    return pid
+
+
+def exited(children):
+    pids = []
+    for pid in children:
+        try:
+            (waited, status) = os.waitpid(pid, os.WNOHANG)
+        except OSError:
+            pids.append(pid)
+            continue
+        if waited:
+            logger.info('worker %s exited with status %s' % (pid, status))
+            pids.append(pid)
+    return pids
+
+
+def wait(pid):
+    while True:
+        try:
+            os.waitpid(pid, 0)
+            return
+        except OSError, e:
+            # interrupted by a signal, try again
+            if e.errno != errno.EINTR:
+                return
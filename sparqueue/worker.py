@@ -5,15 +5,21 @@ import redis
 import sh
 
 import sys
+import threading
 import time
 import traceback
 
 import sparqueue.config
+import sparqueue.environments
+import sparqueue.heartbeat
 import sparqueue.loader
 import sparqueue.logging
+import sparqueue.metrics
 import sparqueue.queue
 import sparqueue.redis
 import sparqueue.reporter
+import sparqueue.runner
+import sparqueue.supervisor
 
 RUN = True
 
@@ -29,67 +35,239 @@ def stop():
 
 def execute(config_filename):
     config = sparqueue.config.get_config(config_filename)
-    jobloader = sparqueue.loader.JobLoader()
+    # not under the temporary directory, whose cleaners would remove them
+    environments = sparqueue.environments.Environments(config.get(
+        'environments',
+        os.path.expanduser(os.path.join('~', '.sparqueue', 'environments'))))
+    jobloader = sparqueue.loader.JobLoader(
+        config.get('reload_interval', 1), config.get('max_instances', 64),
+        config.get('instance_idle_timeout', 0))
 
+    if config.get('processes'):
+        sparqueue.supervisor.supervise(config, jobloader, environments)
+    else:
+        run(config, jobloader, environments)
+
+
+def run(config, jobloader, environments):
+    exporter = sparqueue.metrics.export(config)
+    # instances are created in each process, the supervisor only imports
+    # the classes before forking
+    jobloader.warm(config.get('preload', []), config)
+    try:
+        while RUN:
+            try:
+                loop(config, jobloader, environments)
+            except redis.exceptions.ConnectionError, e:
+                logger.error('Error connecting: ' + str(e))
+                time.sleep(5)
+    finally:
+        if exporter:
+            exporter.stop()
+
+
+def loop(config, jobloader, environments):
+    # unique name for restart
+    redisclient = sparqueue.redis.client(config)
+    # raises QueueException before any slot starts when the storage of a
+    # system isn't the configured one
+    sparqueue.queue.QueueManager(config, redisclient).add_list(
+        config['queues'])
+    heartbeat = None
+    if config.get('heartbeat_interval', 3):
+        heartbeat = sparqueue.heartbeat.Heartbeat(
+            redisclient, config.get('heartbeat_interval', 3))
+        heartbeat.start()
+    # milliseconds between the writes of the progress of the jobs
+    flusher = None
+    if config.get('progress_interval', 500):
+        flusher = sparqueue.reporter.Flusher(
+            redisclient, logger, config.get('progress_interval', 500) / 1000.0)
+        flusher.start()
+    try:
+        run_slots(
+            config, jobloader, environments, redisclient, heartbeat, flusher)
+    finally:
+        if heartbeat:
+            heartbeat.stop()
+        if flusher:
+            flusher.stop()
+
+
+def run_slots(config, jobloader, environments, redisclient, heartbeat,
+              flusher=None):
+    slots = config.get('slots', 1)
+    if slots == 1:
+        run_slot(config, jobloader, environments, redisclient, heartbeat,
+                 flusher=flusher)
+        return
+
+    # concurrent slots, each with its own worker identity
+    threads = []
+    for slot in xrange(slots):
+        thread = threading.Thread(
+            target=run_slot_loop,
+            args=(config, jobloader, environments, redisclient, heartbeat,
+                  slot, flusher),
+            name='slot-%s' % slot)
+        thread.start()
+        threads.append(thread)
+    while threads:
+        # join with a timeout so that signals still get delivered
+        for thread in threads:
+            thread.join(1)
+        threads = [thread for thread in threads if thread.is_alive()]
+
+
+def run_slot_loop(config, jobloader, environments, redisclient, heartbeat,
+                  slot, flusher=None):
     while RUN:
         try:
-            loop(config, jobloader)
+            run_slot(config, jobloader, environments, redisclient, heartbeat,
+                     slot, flusher)
         except redis.exceptions.ConnectionError, e:
             logger.error('Error connecting: ' + str(e))
             time.sleep(5)
+        except Exception, e:
+            # the slot is restarted rather than lost for the process
+            logger.error('slot %s crashed: %s' % (
+                slot, traceback.format_exc(e)))
+            time.sleep(5)
 
 
-def loop(config, jobloader):
-    # unique name for restart
-    redisclient = sparqueue.redis.client(config)
-    queue_manager = sparqueue.queue.QueueManager(config, redisclient)
+def run_slot(config, jobloader, environments, redisclient, heartbeat=None,
+             slot=None, flusher=None):
+    queue_manager = sparqueue.queue.QueueManager(config, redisclient, slot)
     queue_manager.add_list(config['queues'])
+    if heartbeat:
+        heartbeat.add_manager(queue_manager)
+    try:
+        loop_slot(config, jobloader, environments, queue_manager, heartbeat,
+                  flusher)
+    finally:
+        if heartbeat:
+            heartbeat.remove_manager(queue_manager)
 
+
+def loop_slot(config, jobloader, environments, queue_manager, heartbeat,
+              flusher=None):
+    metrics = sparqueue.metrics.METRICS
     while RUN:
         while RUN:
+            start = time.time()
             try:
                 (queue, job) = queue_manager.pop()
+                metrics.observe(
+                    'sparqueue_pop_wait_seconds', time.time() - start,
+                    result='job')
                 break
             except sparqueue.queue.QueueException, e:
-                # TODO: want probably to spawn this in
-                # another cron process instead
-                requeued = queue_manager.requeue()
-                if len(requeued) > 1:
-                    print 'Requeued %s' % ','.join(requeued)
+                metrics.observe(
+                    'sparqueue_pop_wait_seconds', time.time() - start,
+                    result='empty')
+                # requeuing is the job of sparqueue-reaper, unless
+                # configured otherwise for small deployments
+                if config.get('inline_requeue'):
+                    start = time.time()
+                    requeued = queue_manager.requeue()
+                    if requeued:
+                        logger.info('Requeued %s' % ','.join(requeued))
+                    queue_manager.promote()
+                    metrics.inc(
+                        'sparqueue_idle_requeue_seconds_total',
+                        time.time() - start)
 
         # exit before continuing on when not running
         if not RUN:
             break
 
-        logger.info(job)
-
         jobid = job['metadata']['jobid']
-        reporter = sparqueue.reporter.Reporter(logger, queue, jobid)
-
-        logger.info('Processing jobid %s' % jobid)
-
-        if 'install' in job:
-            if 'pip' in job['install']:
-                reporter.step('installing %s' % job['install']['pip'])
-                try:
-                    logger.info(sh.pip('install', job['install']['pip']))
-                except sh.ErrorReturnCode, e:
-                    logger.error('problem installing %s: %s' % (
-                        job['metadata']['jobid'], traceback.format_exc(e)))
-                    queue.failed(e)
-                    continue
+        if heartbeat:
+            heartbeat.started(queue, jobid)
         try:
-            jobInstance = jobloader.getInstance(job['class'], config)
-            if not jobInstance:
-                logger.error('Invalid class name: %s' % job['class'])
-            job['vars']['reporter'] = reporter
-            output = jobInstance.perform(**job['vars'])
-            reporter.finish()
-            queue.success(output, reporter.stats())
+            process(config, jobloader, environments, queue, job, flusher)
+        except redis.exceptions.ConnectionError:
+            raise
         except Exception, e:
-            logger.error('problem processing %s: %s' % (
-                job['metadata']['jobid'], traceback.format_exc(e)))
-            queue.failed(e)
+            # e.g. finalizing failed, the slot goes on with the next job
+            logger.error('problem finishing %s: %s' % (
+                jobid, traceback.format_exc(e)))
+        finally:
+            if heartbeat:
+                heartbeat.finished(jobid)
 
     logger.info('Exiting gracefully, no current queue jobs left unprocessed')
     logger.info('Exited: %s' % queue_manager.exit())
+
+
+def process(config, jobloader, environments, queue, job, flusher=None):
+    # runs job and counts it by class and outcome with its duration
+    start = time.time()
+    status = execute_job(config, jobloader, environments, queue, job, flusher)
+    metrics = sparqueue.metrics.METRICS
+    metrics.inc('sparqueue_jobs_total', 1, status=status, **{
+        'class': job['class']})
+    metrics.observe(
+        'sparqueue_job_duration_seconds', time.time() - start,
+        **{'class': job['class']})
+
+
+def execute_job(config, jobloader, environments, queue, job, flusher=None):
+    # returns success or failed once the job is finalized
+    logger.info(job)
+
+    jobid = job['metadata']['jobid']
+    reporter = sparqueue.reporter.Reporter(logger, queue, jobid, flusher)
+
+    logger.info('Processing jobid %s' % jobid)
+
+    path = None
+    if 'install' in job:
+        if 'pip' in job['install']:
+            reporter.step('installing %s' % job['install']['pip'])
+            try:
+                path = environments.install(job['install']['pip'])
+            except sh.ErrorReturnCode, e:
+                logger.error('problem installing %s: %s' % (
+                    job['metadata']['jobid'], traceback.format_exc(e)))
+                reporter.close()
+                finalize(queue.failed, e, jobid)
+                return 'failed'
+    if path:
+        # the child process reports the progress of the job from now on
+        reporter.close()
+        try:
+            (output, stats) = sparqueue.runner.run(config, queue, job, path)
+        except Exception, e:
+            logger.error('problem processing %s: %s' % (
+                job['metadata']['jobid'], traceback.format_exc(e)))
+            finalize(queue.failed, e, jobid)
+            return 'failed'
+        finalize(queue.success, output, stats, jobid)
+        return 'success'
+    try:
+        jobInstance = jobloader.getInstance(job['class'], config)
+        if not jobInstance:
+            logger.error('Invalid class name: %s' % job['class'])
+        job['vars']['reporter'] = reporter
+        if job['metadata'].get('profile'):
+            output = reporter.profile(jobInstance.perform, **job['vars'])
+        else:
+            output = jobInstance.perform(**job['vars'])
+        reporter.finish()
+        finalize(queue.success, output, reporter.stats(), jobid)
+        return 'success'
+    except Exception, e:
+        logger.error('problem processing %s: %s' % (
+            job['metadata']['jobid'], traceback.format_exc(e)))
+        reporter.close()
+        finalize(queue.failed, e, jobid)
+        return 'failed'
+
+
+def finalize(function, *args):
+    start = time.time()
+    function(*args)
+    sparqueue.metrics.METRICS.observe(
+        'sparqueue_redis_roundtrip_seconds', time.time() - start,
+        op='finalize')
@@ -0,0 +1,94 @@
+from nose.tools import *
+
+import json
+import shutil
+import tempfile
+import time
+
+import redis
+import sparqueue.archive
+import sparqueue.queue
+
+
+class TestArchive:
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.queue_name = "queueC"
+        self.system_name = "TestC %r" % time.time()
+        self.queue = sparqueue.queue.RedisQueue(
+            self.redis_client, self.system_name, self.queue_name)
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    @classmethod
+    def setup_class(cls):
+        TestArchive.redis_client = redis.Redis()
+
+    def test_append_get(self):
+        archive = sparqueue.archive.Archive(self.directory, segment_size=10)
+        archive.append([('a', {'n': 1}), ('b', {'n': 2})])
+        archive.append([('c', {'n': 3})])
+        assert archive.get('b') == {'n': 2}
+        assert archive.get('d') is None
+        archive.close()
+
+        archive = sparqueue.archive.Archive(self.directory, segment_size=10)
+        assert archive.get('a') == {'n': 1}
+        assert archive.get('c') == {'n': 3}
+        archive.close()
+
+    def test_retire(self):
+        self.queue.archive = sparqueue.archive.Archive(self.directory)
+        jobids = []
+        for i in xrange(3):
+            jobid = self.queue.push({'class': 'dummy', 'vars': {'i': i}})
+            self.queue.activate_job(jobid)
+            self.queue.success(i)
+            jobids.append(jobid)
+
+        assert self.queue.retire(max_count=1) == 2
+        assert self.redis_client.zcard(self.queue.finished_set) == 1
+        assert self.redis_client.scard(self.queue.success_set) == 1
+        assert not self.redis_client.hexists(self.queue.jobs_hash, jobids[0])
+
+        job = self.queue.job(jobids[0])
+        assert job['output'] == 0, job
+        assert job['metadata']['status'] == 'SUCCESS'
+        assert self.queue.status(jobids[0])['state'] == 'SUCCESS'
+
+        assert self.queue.retire(max_age=0) == 1
+        assert self.queue.job(jobids[2])['output'] == 2
+        self.queue.archive.close()
+
+    def test_reader_refresh(self):
+        writer = sparqueue.archive.Archive(self.directory)
+        reader = sparqueue.archive.Archive(self.directory, refresh_interval=0)
+        assert reader.get('a') is None
+        writer.append([('a', {'n': 1})])
+        assert reader.get('a') == {'n': 1}
+        writer.close()
+        reader.close()
+
+    def test_archiver_leader(self):
+        manager = sparqueue.queue.QueueManager({}, self.redis_client)
+        queues = [{'system': self.system_name, 'queue': self.queue_name,
+                   'retention': {'max_count': 0}}]
+        manager.add_list(queues)
+        queue = manager.get(self.system_name, self.queue_name)
+        queue.archive = sparqueue.archive.Archive(self.directory)
+        jobid = queue.push({'class': 'dummy', 'vars': {}})
+        queue.activate_job(jobid)
+        queue.success('done')
+
+        first = sparqueue.archive.Archiver(manager, queues)
+        second = sparqueue.archive.Archiver(manager, queues)
+        assert first.archive() == 1
+        jobid = queue.push({'class': 'dummy', 'vars': {}})
+        queue.activate_job(jobid)
+        queue.success('done')
+        # only the leader archives
+        assert second.archive() == 0
+        assert first.archive() == 1
+        queue.archive.close()
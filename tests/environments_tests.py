@@ -0,0 +1,44 @@
+from nose.tools import *
+
+import os
+import shutil
+import tempfile
+
+import sh
+import sparqueue.environments
+
+
+class TestEnvironments:
+
+    def setup(self):
+        self.root = tempfile.mkdtemp()
+        self.environments = sparqueue.environments.Environments(
+            os.path.join(self.root, 'environments'))
+
+    def teardown(self):
+        shutil.rmtree(self.root)
+
+    def test_path_per_spec(self):
+        assert_not_equal(self.environments.path('package==1.0'),
+                         self.environments.path('package==1.1'))
+        assert_equal(self.environments.path('package==1.0'),
+                     self.environments.path('package==1.0'))
+
+    def test_installed_once(self):
+        spec = os.path.join(self.root, 'missing-package')
+        path = self.environments.path(spec)
+        os.makedirs(path)
+        # reused without running pip
+        assert_equal(path, self.environments.install(spec))
+        shutil.rmtree(path)
+        # installed again once removed
+        assert_raises(
+            sh.ErrorReturnCode, self.environments.install, spec)
+
+    def test_failed_install(self):
+        spec = os.path.join(self.root, 'missing-package')
+        assert_raises(
+            sh.ErrorReturnCode, self.environments.install, spec)
+        assert_equal(['%s.lock' % os.path.basename(
+            self.environments.path(spec))],
+            os.listdir(os.path.join(self.root, 'environments')))
@@ -0,0 +1,45 @@
+from nose.tools import *
+
+import time
+
+import redis
+import sparqueue.heartbeat
+import sparqueue.queue
+
+
+class TestHeartbeat:
+
+    def setup(self):
+        self.queue_name = "queueC"
+        self.system_name = "TestC %r" % time.time()
+        self.queue_manager = sparqueue.queue.QueueManager(
+            {}, self.redis_client)
+        self.queue = self.queue_manager.add(self.system_name, self.queue_name)
+        self.heartbeat = sparqueue.heartbeat.Heartbeat(self.redis_client)
+        self.heartbeat.add_manager(self.queue_manager)
+
+    @classmethod
+    def setup_class(cls):
+        TestHeartbeat.redis_client = redis.Redis()
+
+    def test_beat_renews_lease(self):
+        jobid = self.queue.push({"class": "dummy", "vars": {}})
+        self.queue_manager.pop(timeout=1)
+        self.redis_client.zadd(self.queue.leases_set, jobid, 0)
+        self.heartbeat.started(self.queue, jobid)
+        self.heartbeat.beat()
+        expiry = self.redis_client.zscore(self.queue.leases_set, jobid)
+        assert expiry > time.time(), expiry
+        assert self.queue_manager.requeue() == []
+
+    def test_beat_finished_job(self):
+        jobid = self.queue.push({"class": "dummy", "vars": {}})
+        self.queue_manager.pop(timeout=1)
+        self.heartbeat.started(self.queue, jobid)
+        self.queue.success('done', jobid=jobid)
+        self.heartbeat.beat()
+        assert self.redis_client.zscore(self.queue.leases_set, jobid) is None
+        self.heartbeat.finished(jobid)
+        activity = self.redis_client.hget(
+            self.queue.activity_hash, self.queue.client_id)
+        assert float(activity) > time.time() - 1
@@ -0,0 +1,81 @@
+from nose.tools import *
+
+import json
+import time
+
+import redis
+import sparqueue.incoming
+import sparqueue.queue
+
+
+class TestIncoming:
+
+    def setup(self):
+        self.system_name = "TestC %r" % time.time()
+        self.manager = sparqueue.queue.QueueManager({}, self.redis_client)
+        self.manager.add(self.system_name, 'queueA')
+        self.manager.add(self.system_name, 'queueB')
+        self.incoming = sparqueue.incoming.Incoming(
+            self.manager, '%s|incoming' % self.system_name, batch=2)
+
+    @classmethod
+    def setup_class(cls):
+        TestIncoming.redis_client = redis.Redis()
+
+    def job(self, queue, uuid):
+        return json.dumps({
+            'class': 'example.job.ExampleJob',
+            'vars': {},
+            'metadata': {
+                'system': self.system_name, 'queue': queue, 'uuid': uuid}})
+
+    def test_ingest(self):
+        self.redis_client.lpush(
+            self.incoming.key,
+            self.job('queueA', 'u1'),
+            self.job('queueB', 'u2'),
+            self.job('queueC', 'u3'),
+            'not json')
+        assert self.incoming.ingest() == 2
+        assert self.incoming.ingest() == 0
+        assert self.incoming.ingest() == 0
+
+        queue = self.manager.get(self.system_name, 'queueA')
+        jobid = self.incoming.jobid('u1')
+        assert queue.job(jobid)['metadata']['uuid'] == 'u1'
+        assert self.redis_client.lrange(queue.pending_list, 0, -1) == [jobid]
+        queue = self.manager.get(self.system_name, 'queueB')
+        assert queue.job(self.incoming.jobid('u2'))
+        assert self.incoming.jobid('u3') is None
+        invalid = self.redis_client.lrange(self.incoming.invalid_list, 0, -1)
+        assert len(invalid) == 2, invalid
+
+    def test_crashed_consumer(self):
+        self.redis_client.lpush(
+            self.incoming.key,
+            self.job('queueA', 'u1'),
+            self.job('queueA', 'u2'),
+            self.job('queueA', 'u3'))
+        # taken then crashed before submitting
+        assert len(self.incoming.take()) == 2
+        other = sparqueue.incoming.Incoming(
+            self.manager, self.incoming.key, batch=2)
+        assert other.ingest() == 1
+        assert other.jobid('u3')
+        assert other.ingest() == 0
+
+        self.redis_client.zadd(
+            self.incoming.consumers_set, self.incoming.consumer, 0)
+        assert other.ingest() == 2
+        assert other.jobid('u1') and other.jobid('u2')
+        assert not self.redis_client.exists(self.incoming.processing_list)
+
+    def test_submitted_once(self):
+        self.redis_client.lpush(self.incoming.key, self.job('queueA', 'u1'))
+        assert self.incoming.ingest() == 1
+        jobid = self.incoming.jobid('u1')
+        assert self.redis_client.ttl(self.incoming.jobids_prefix + 'u1') > 0
+        # the same uuid again, as after a crash once submitted
+        self.redis_client.lpush(self.incoming.key, self.job('queueA', 'u1'))
+        assert self.incoming.ingest() == 0
+        assert self.incoming.jobid('u1') == jobid
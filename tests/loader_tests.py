@@ -0,0 +1,85 @@
+from nose.tools import *
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import sparqueue.loader
+
+JOBS = '''
+class %(name)s(object):
+    instances = 0
+
+    @classmethod
+    def instantiate(cls, config, parameters):
+        cls.instances = cls.instances + 1
+        return cls()
+
+    def perform(self):
+        return %(output)r
+'''
+
+
+class TestJobLoader:
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        sys.path.insert(0, self.directory)
+        self.module = 'loaderjobs%s' % int(time.time() * 1000000)
+        self.write('A', 1)
+
+    def teardown(self):
+        sys.path.remove(self.directory)
+        sys.modules.pop(self.module, None)
+        shutil.rmtree(self.directory)
+
+    def write(self, name, output, mtime=None):
+        filename = os.path.join(self.directory, '%s.py' % self.module)
+        f = open(filename, 'w')
+        try:
+            f.write(''.join(
+                JOBS % {'name': name, 'output': output} for name in 'ABC'))
+        finally:
+            f.close()
+        if mtime:
+            os.utime(filename, (mtime, mtime))
+
+    def test_cached_instance(self):
+        loader = sparqueue.loader.JobLoader(reload_interval=None)
+        clazz = '%s.A' % self.module
+        instance = loader.getInstance(clazz, {})
+        assert loader.getInstance(clazz, {}) is instance
+        assert_equal(1, loader.getClass(clazz).instances)
+
+    def test_warm(self):
+        loader = sparqueue.loader.JobLoader()
+        loader.warm(['%s.A' % self.module, '%s.Missing' % self.module], {})
+        assert_equal(1, loader.getClass('%s.A' % self.module).instances)
+        assert_equal(['%s.A' % self.module], list(loader.clazz_to_object))
+
+    def test_least_recently_used(self):
+        loader = sparqueue.loader.JobLoader(max_instances=2)
+        for name in 'ABAC':
+            loader.getInstance('%s.%s' % (self.module, name), {})
+        assert_equal(['%s.A' % self.module, '%s.C' % self.module],
+                     list(loader.clazz_to_object))
+
+    def test_idle(self):
+        loader = sparqueue.loader.JobLoader(idle_timeout=60)
+        loader.getInstance('%s.A' % self.module, {})
+        (instance, last) = loader.clazz_to_object['%s.A' % self.module]
+        loader.clazz_to_object['%s.A' % self.module] = (instance, last - 61)
+        loader.getInstance('%s.B' % self.module, {})
+        assert_equal(['%s.B' % self.module], list(loader.clazz_to_object))
+
+    def test_reload(self):
+        loader = sparqueue.loader.JobLoader(reload_interval=60)
+        clazz = '%s.A' % self.module
+        assert_equal(1, loader.getInstance(clazz, {}).perform())
+        self.write('A', 2, time.time() + 10)
+        # not checked before reload_interval
+        assert_equal(1, loader.getInstance(clazz, {}).perform())
+        loader.clazz_to_checked[clazz] = 0
+        assert_equal(2, loader.getInstance(clazz, {}).perform())
@@ -0,0 +1,42 @@
+from nose.tools import *
+
+import os
+import shutil
+import tempfile
+
+import sparqueue.metrics
+
+
+class TestMetrics:
+
+    def setup(self):
+        self.metrics = sparqueue.metrics.Metrics()
+
+    def test_render(self):
+        self.metrics.inc('jobs_total', status='success', **{'class': 'a.B'})
+        self.metrics.inc('jobs_total', 2, status='success', **{'class': 'a.B'})
+        self.metrics.observe('duration_seconds', 0.2, **{'class': 'a.B'})
+        self.metrics.observe('duration_seconds', 7200, **{'class': 'a.B'})
+        self.metrics.gauge('rss_bytes', lambda: 1024)
+        lines = self.metrics.render().splitlines()
+        assert '# TYPE jobs_total counter' in lines
+        assert 'jobs_total{class="a.B",status="success"} 3' in lines, lines
+        assert 'duration_seconds_bucket{class="a.B",le="0.1"} 0' in lines
+        assert 'duration_seconds_bucket{class="a.B",le="0.5"} 1' in lines
+        assert 'duration_seconds_bucket{class="a.B",le="+Inf"} 2' in lines
+        assert 'duration_seconds_sum{class="a.B"} 7200.2' in lines
+        assert 'duration_seconds_count{class="a.B"} 2' in lines
+        assert 'rss_bytes 1024' in lines
+
+    def test_file_exporter(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'worker.prom')
+            self.metrics.inc('jobs_total')
+            exporter = sparqueue.metrics.FileExporter(
+                self.metrics, filename)
+            exporter.write()
+            assert file(filename).read() == self.metrics.render()
+            assert os.listdir(directory) == ['worker.prom']
+        finally:
+            shutil.rmtree(directory)
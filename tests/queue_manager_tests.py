@@ -5,6 +5,7 @@ import time
 
 import redis
 import sparqueue.queue
+import sparqueue.scripts
 
 class TestQueueManager:
 
@@ -12,7 +13,7 @@ class TestQueueManager:
         print ("TestUM:setup() before each test method")
         self.queue_manager = sparqueue.queue.QueueManager({}, TestQueueManager.redis_client)
         self.queue_name = "queueC"
-        self.system_name = "TestC %s" % time.time()
+        self.system_name = "TestC %r" % time.time()
 
     def teardown(self):
         print ("TestUM:teardown() after each test method")
@@ -50,3 +51,172 @@ class TestQueueManager:
 
     def test_requeue(self):
         assert len(self.queue_manager.requeue()) == 0
+
+    def test_pop_script(self):
+        queue = self.queue_manager.add(self.system_name, self.queue_name)
+        jobid = queue.push({"class": "dummy", "vars": {}})
+        (popped, job) = self.queue_manager.pop(timeout=1)
+        assert popped is queue
+        assert job['metadata']['jobid'] == jobid
+        current = self.redis_client.hget(queue.current_hash, queue.client_id)
+        assert current == jobid, current
+        assert queue.status(jobid)['state'] == 'ACTIVE'
+
+    def test_pop_script_skips_cancelled(self):
+        queue = self.queue_manager.add(self.system_name, self.queue_name)
+        cancelled = queue.push({"class": "dummy", "vars": {}})
+        jobid = queue.push({"class": "dummy", "vars": {}})
+        queue.cancel(cancelled)
+        (popped, job) = self.queue_manager.pop(timeout=1)
+        assert job['metadata']['jobid'] == jobid
+
+    def test_pop_backlog(self):
+        queue = self.queue_manager.add(self.system_name, self.queue_name)
+        # more jobs than wakeup tokens, none of the pops blocks
+        jobids = [queue.push({"class": "dummy", "vars": {}})
+                  for i in xrange(sparqueue.scripts.WAKEUP_TOKENS + 10)]
+        start = time.time()
+        popped = [self.queue_manager.pop(timeout=1)[1]['metadata']['jobid']
+                  for jobid in jobids]
+        assert sorted(popped) == sorted(jobids)
+        assert time.time() - start < 1, time.time() - start
+
+    def test_requeue_expired_lease(self):
+        self.queue_manager = sparqueue.queue.QueueManager(
+            {'lease_timeout': -1}, TestQueueManager.redis_client)
+        queue = self.queue_manager.add(self.system_name, self.queue_name)
+        jobid = queue.push({"class": "dummy", "vars": {}})
+        self.queue_manager.pop(timeout=1)
+        assert self.queue_manager.requeue() == [jobid]
+        pending = self.redis_client.lrange(queue.pending_list, 0, -1)
+        assert pending == [jobid], pending
+        assert self.queue_manager.requeue() == []
+
+    def test_requeue_active_lease(self):
+        queue = self.queue_manager.add(self.system_name, self.queue_name)
+        queue.push({"class": "dummy", "vars": {}})
+        self.queue_manager.pop(timeout=1)
+        assert self.queue_manager.requeue() == []
+
+    def test_pop_hash_storage(self):
+        self.queue_manager = sparqueue.queue.QueueManager(
+            {'storage': 'hash'}, TestQueueManager.redis_client)
+        queue = self.queue_manager.add(self.system_name, self.queue_name)
+        jobid = queue.push({"class": "dummy", "vars": {"a": 1}})
+        (popped, job) = self.queue_manager.pop(timeout=1)
+        assert job['metadata']['jobid'] == jobid
+        assert job['vars'] == {"a": 1}, job
+
+    def test_slots(self):
+        managers = [
+            sparqueue.queue.QueueManager({}, self.redis_client, slot)
+            for slot in xrange(2)]
+        queues = [manager.add(self.system_name, self.queue_name)
+                  for manager in managers]
+        first = queues[0].push({"class": "dummy", "vars": {}})
+        second = queues[0].push({"class": "dummy", "vars": {}})
+        managers[0].pop(timeout=1)
+        managers[1].pop(timeout=1)
+        queues[1].success('second', jobid=second)
+        queues[0].success('first', jobid=first)
+        assert queues[0].job(first)['output'] == 'first'
+        assert queues[0].job(second)['output'] == 'second'
+        slots = sorted(w['slot'] for w in queues[0].workers())
+        assert slots == ['0', '1'], slots
+
+    def test_worker_registry(self):
+        managers = [
+            sparqueue.queue.QueueManager({}, self.redis_client, slot)
+            for slot in xrange(2)]
+        queues = [manager.add(self.system_name, self.queue_name)
+                  for manager in managers]
+        jobid = queues[0].push({"class": "dummy", "vars": {}})
+        managers[0].pop(timeout=1)
+        queues[0].step(jobid, 'working')
+        queues[1].active_worker()
+        registry = queues[1].worker_registry()
+        workers = dict((w['slot'], w) for w in registry['workers'])
+        assert workers['0']['jobid'] == jobid
+        assert workers['0']['step'] == 'working'
+        assert 0 <= workers['0']['lease_age'] < 1, workers['0']
+        assert workers['0']['status'] == 'PROCESSING'
+        assert workers['1']['jobid'] is None
+        assert workers['1']['status'] == 'IDLE'
+        assert registry['statuses'] == {'IDLE': 1, 'PROCESSING': 1}
+        hostname = workers['0']['hostname']
+        assert registry['hosts'] == {hostname: {'IDLE': 1, 'PROCESSING': 1}}
+        idle = queues[0].workers('IDLE')
+        assert [w['slot'] for w in idle] == ['1'], idle
+
+    def test_pop_priority(self):
+        queue = self.queue_manager.add(self.system_name, self.queue_name)
+        low = queue.push(
+            {"class": "dummy", "vars": {}, "metadata": {"priority": "low"}})
+        normal = queue.push({"class": "dummy", "vars": {}})
+        high = queue.push(
+            {"class": "dummy", "vars": {}, "metadata": {"priority": "high"}})
+        popped = [self.queue_manager.pop(timeout=1)[1]['metadata']['jobid']
+                  for i in xrange(3)]
+        assert popped == [high, normal, low], popped
+
+    @raises(sparqueue.queue.QueueException)
+    def test_push_invalid_priority(self):
+        queue = self.queue_manager.add(self.system_name, self.queue_name)
+        queue.push(
+            {"class": "dummy", "vars": {}, "metadata": {"priority": "urgent"}})
+
+    def test_pop_weighted(self):
+        heavy = self.queue_manager.add(self.system_name, "heavy", 3)
+        light = self.queue_manager.add(self.system_name, "light", 1)
+        for i in xrange(8):
+            heavy.push({"class": "dummy", "vars": {}})
+            light.push({"class": "dummy", "vars": {}})
+        served = [self.queue_manager.pop(timeout=1)[0].queue_name
+                  for i in xrange(8)]
+        assert served.count("heavy") == 6, served
+        assert served.count("light") == 2, served
+
+    def test_pop_weighted_backlog(self):
+        urgent = self.queue_manager.add(self.system_name, "urgent")
+        bulk = self.queue_manager.add(self.system_name, "bulk")
+        # urgent served alone for a while, then bulk gets a backlog
+        for i in xrange(20):
+            urgent.push({"class": "dummy", "vars": {}})
+            self.queue_manager.pop(timeout=1)
+        for i in xrange(8):
+            urgent.push({"class": "dummy", "vars": {}})
+            bulk.push({"class": "dummy", "vars": {}})
+        served = [self.queue_manager.pop(timeout=1)[0].queue_name
+                  for i in xrange(8)]
+        assert served.count("urgent") >= 3, served
+        assert served[:3].count("urgent") >= 1, served
+
+    def test_requeue_priority(self):
+        self.queue_manager = sparqueue.queue.QueueManager(
+            {'lease_timeout': -1}, TestQueueManager.redis_client)
+        queue = self.queue_manager.add(self.system_name, self.queue_name)
+        jobid = queue.push(
+            {"class": "dummy", "vars": {}, "metadata": {"priority": "high"}})
+        self.queue_manager.pop(timeout=1)
+        assert self.queue_manager.requeue() == [jobid]
+        pending = self.redis_client.lrange(
+            queue.pending_lists['high'], 0, -1)
+        assert pending == [jobid], pending
+
+    def test_pop_crash_window(self):
+        queue = self.queue_manager.add(self.system_name, self.queue_name)
+        jobid = queue.push({"class": "dummy", "vars": {}})
+        # a worker woken up then dying before its dequeue script only
+        # consumed a token, the job stays pending
+        assert self.redis_client.brpop(queue.wakeup_list, 1)
+        assert queue.status(jobid)['state'] == 'PENDING'
+        assert [job['metadata']['jobid'] for job in
+                queue.list(set(['PENDING']))] == [jobid]
+        assert queue.list(set(['ACTIVE'])) == []
+
+        # and is dequeued by the next one
+        (popped, job) = self.queue_manager.pop(timeout=1)
+        assert job['metadata']['jobid'] == jobid
+        assert queue.status(jobid)['state'] == 'ACTIVE'
+        assert [job['metadata']['jobid'] for job in
+                queue.list(set(['ACTIVE']))] == [jobid]
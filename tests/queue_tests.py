@@ -1,10 +1,12 @@
 
 from nose.tools import *
 
+import threading
 import time
 import json
 import redis
 import sparqueue.queue
+import sparqueue.store
 
 HELLO_WORLD_JOB = """
 {
@@ -23,7 +25,7 @@ class TestQueue:
     def setup(self):
         print ("TestUM:setup() before each test method")
         self.queue_name = "queueC"
-        self.system_name = "TestC %s" % time.time()
+        self.system_name = "TestC %r" % time.time()
         self.queue = sparqueue.queue.RedisQueue(self.redis_client, self.system_name, self.queue_name)
 
     @classmethod
@@ -38,4 +40,238 @@ class TestQueue:
         assert jobid in jobids, '%s does not contain %s' % (jobids, jobid)
         self.queue.cancel(jobid)
         l = self.queue.list()
-        assert len(l) == 0, 'Expected empty: %s' % l
\ No newline at end of file
+        assert len(l) == 0, 'Expected empty: %s' % l
+
+    def test_push_many(self):
+        configs = (json.loads(HELLO_WORLD_JOB) for i in xrange(5))
+        jobids = list(self.queue.push_many(configs, chunk_size=2))
+        assert len(jobids) == 5
+        assert len(set(jobids)) == 5
+        pending = self.redis_client.lrange(self.queue.pending_list, 0, -1)
+        assert set(pending) == set(jobids), pending
+        for jobid in jobids:
+            assert self.queue.job(jobid)['metadata']['jobid'] == jobid
+
+    def test_validate(self):
+        self.queue.validate(json.loads(HELLO_WORLD_JOB))
+        assert_raises(sparqueue.queue.QueueException,
+                      self.queue.validate, {'class': 'dummy'})
+        config = json.loads(HELLO_WORLD_JOB)
+        config['metadata'] = {'priority': 'urgent'}
+        assert_raises(sparqueue.queue.QueueException,
+                      self.queue.push, config)
+
+    def test_scan_pages(self):
+        configs = (json.loads(HELLO_WORLD_JOB) for i in xrange(5))
+        jobids = list(self.queue.push_many(configs))
+        (cursor, jobs) = self.queue.scan('PENDING', 0, 2)
+        assert cursor == 2, cursor
+        assert len(jobs) == 2
+        assert jobs[0]['metadata']['status'] == 'PENDING'
+        (cursor, jobs) = self.queue.scan('PENDING', 4, 2)
+        assert cursor == 0, cursor
+        assert len(jobs) == 1
+        listed = [job['metadata']['jobid'] for job in
+                  self.queue.iterate('PENDING', limit=2)]
+        assert sorted(listed) == sorted(jobids), listed
+        assert self.queue.list(set(['SUCCESS', 'FAILED'])) == []
+
+    def test_scan_pending_lanes(self):
+        jobids = []
+        for priority in ['low', 'normal', 'high', 'normal']:
+            config = json.loads(HELLO_WORLD_JOB)
+            config['metadata'] = {'priority': priority}
+            jobids.append(self.queue.push(config))
+        (cursor, jobs) = self.queue.scan('PENDING', 0, 3)
+        assert cursor == 3, cursor
+        first = [job['metadata']['jobid'] for job in jobs]
+        assert first[0] == jobids[2], first
+        (cursor, jobs) = self.queue.scan('PENDING', 3, 3)
+        assert cursor == 0, cursor
+        assert [job['metadata']['jobid'] for job in jobs] == [jobids[0]]
+
+    def test_scheduled(self):
+        jobid = self.queue.push(
+            json.loads(HELLO_WORLD_JOB), run_at=time.time() + 60)
+        assert self.queue.status(jobid)['state'] == 'SCHEDULED'
+        assert self.queue.promote() == 0
+        self.redis_client.zadd(self.queue.scheduled_set, jobid, 0)
+        assert self.queue.promote() == 1
+        pending = self.redis_client.lrange(self.queue.pending_list, 0, -1)
+        assert pending == [jobid], pending
+
+    def test_retry(self):
+        config = json.loads(HELLO_WORLD_JOB)
+        config['metadata'] = {'max_retries': 1, 'backoff': 30}
+        jobid = self.queue.push(config)
+        self.queue.activate_job(jobid)
+        self.queue.failed(Exception('transient'), jobid)
+        assert self.queue.status(jobid)['state'] == 'SCHEDULED'
+        run_at = self.redis_client.zscore(self.queue.scheduled_set, jobid)
+        assert run_at > time.time() + 25, run_at
+        job = self.queue.job(jobid)
+        assert job['metadata']['attempts'] == 1
+        assert job['last_error'] == 'transient'
+
+        self.redis_client.zadd(self.queue.scheduled_set, jobid, 0)
+        self.queue.promote()
+        self.queue.activate_job(jobid)
+        self.queue.failed(Exception('again'), jobid)
+        assert self.queue.status(jobid)['state'] == 'FAILED'
+
+    def test_events(self):
+        pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.queue.events_channel)
+        pubsub.get_message(timeout=1)
+        jobid = self.queue.push(json.loads(HELLO_WORLD_JOB))
+        self.queue.activate_job(jobid)
+        self.queue.step(jobid, 'working')
+        self.queue.success('done', {}, jobid)
+        events = []
+        while True:
+            message = pubsub.get_message(timeout=1)
+            if message is None:
+                break
+            events.append(json.loads(message['data']))
+        pubsub.close()
+        states = [event['state'] for event in events]
+        assert states == ['PENDING', 'ACTIVE', 'ACTIVE', 'SUCCESS'], states
+        assert events[2]['step'] == 'working'
+        assert set(event['jobid'] for event in events) == set([jobid])
+        assert events[0]['system'] == self.system_name
+        assert events[0]['queue'] == self.queue_name
+
+    def test_wait(self):
+        jobid = self.queue.push(json.loads(HELLO_WORLD_JOB))
+        self.queue.activate_job(jobid)
+        status = self.queue.wait(jobid, 1)
+        assert status['state'] == 'ACTIVE', status
+        start = time.time()
+        assert self.queue.wait(jobid, 0)['state'] == 'ACTIVE'
+        assert time.time() - start < 0.5
+
+        timer = threading.Timer(
+            0.2, self.queue.success, ('done', {}, jobid))
+        timer.start()
+        status = self.queue.wait(jobid, 5)
+        timer.join()
+        assert status['state'] == 'SUCCESS', status
+        assert status['output'] == 'done', status
+        # a second waiter gets the completion too
+        assert self.queue.wait(jobid, 1)['output'] == 'done'
+
+        jobid = self.queue.push(json.loads(HELLO_WORLD_JOB))
+        self.queue.cancel(jobid)
+        assert self.queue.wait(jobid, 1)['state'] == 'CANCELLED'
+
+    def test_cancel_active(self):
+        jobid = self.queue.push(json.loads(HELLO_WORLD_JOB))
+        self.queue.activate_job(jobid)
+        self.queue.cancel(jobid)
+        status = self.queue.status(jobid)
+        # finished by its worker afterwards
+        self.queue.success('done', {}, jobid)
+        assert self.queue.job(jobid) is None
+        assert not self.redis_client.sismember(self.queue.success_set, jobid)
+        assert not self.redis_client.exists(self.queue.prefix('jobs', jobid))
+        assert self.queue.status(jobid) == status
+        assert self.redis_client.hget(
+            self.queue.current_hash, self.queue.client_id) is None
+
+    def test_cancel_many(self):
+        jobids = list(self.queue.push_many(
+            json.loads(HELLO_WORLD_JOB) for i in xrange(3)))
+        jobs = self.queue.cancel_many(jobids[:2] + ['unknown'], chunk_size=2)
+        assert [job['metadata']['jobid'] for job in jobs[:2]] == jobids[:2]
+        assert jobs[2] is None
+        assert self.queue.status(jobids[2])['state'] != 'UNKNOWN'
+
+    def test_status_jobs_many(self):
+        jobids = list(self.queue.push_many(
+            json.loads(HELLO_WORLD_JOB) for i in xrange(3)))
+        self.queue.activate_job(jobids[0])
+        self.queue.success('done', {}, jobids[0])
+        statuses = self.queue.status_many(jobids + ['unknown'], chunk_size=2)
+        assert [s['jobid'] for s in statuses] == jobids + ['unknown']
+        assert statuses[0]['state'] == 'SUCCESS'
+        assert statuses[3]['state'] == 'UNKNOWN'
+        jobs = self.queue.jobs_many(['unknown'] + jobids, chunk_size=2)
+        assert jobs[0] is None
+        assert [job['metadata']['jobid'] for job in jobs[1:]] == jobids
+        assert jobs[1]['output'] == 'done'
+
+    def test_stats(self):
+        jobids = list(self.queue.push_many(
+            json.loads(HELLO_WORLD_JOB) for i in xrange(3)))
+        self.queue.activate_job(jobids[0])
+        self.queue.success('done', {}, jobids[0])
+        self.queue.activate_job(jobids[1])
+        self.queue.cancel(jobids[2])
+        stats = self.queue.stats()
+        # activate_job doesn't pop the jobids from their lane
+        assert stats['lanes']['normal'] == 3, stats
+        assert stats['active'] == 1
+        assert stats['success'] == 1
+        assert stats['cancelled'] == 1
+        throughput = stats['throughput']['1m']
+        assert throughput['pushed'] == 3, throughput
+        assert throughput['success'] == 1
+        assert throughput['cancelled'] == 1
+        # the minute before, 30 finished jobs
+        self.redis_client.hset(
+            self.queue._counters(time.time() - 60), 'success', 30)
+        stats = self.queue.stats()
+        assert stats['throughput']['1m']['rate'] == 0.5, stats['throughput']
+        assert stats['throughput']['5m']['rate'] == 0.1, stats['throughput']
+        assert stats['wait']['count'] == 2
+        assert stats['wait']['p50'] == 0.01, stats['wait']
+        assert stats['run']['count'] == 1
+        assert stats['run']['buckets'][0] == ('0.01', 1)
+
+
+class TestHashStoreQueue(TestQueue):
+
+    def setup(self):
+        self.queue_name = "queueC"
+        self.system_name = "TestC %r" % time.time()
+        self.queue = sparqueue.queue.RedisQueue(
+            self.redis_client, self.system_name, self.queue_name,
+            {'storage': 'hash'})
+
+    def test_fields(self):
+        jobid = self.queue.push(json.loads(HELLO_WORLD_JOB))
+        key = self.queue.store.job_key(jobid)
+        assert self.redis_client.hget(key, 'vars')
+        job = self.queue.job(jobid, ['metadata'])
+        assert set(job) == set(['class', 'metadata']), job
+        job = self.queue.job(jobid)
+        assert job['vars']['string'] == 'Hello World'
+        self.queue.activate_job(jobid)
+        self.queue.success({'done': True})
+        job = self.queue.job(jobid)
+        assert job['output'] == {'done': True}
+        assert job['vars']['string'] == 'Hello World'
+        self.queue.cancel(jobid)
+        assert not self.redis_client.exists(key)
+
+    def test_migrate(self):
+        jobid = self.queue.push(json.loads(HELLO_WORLD_JOB))
+        blob = sparqueue.store.BlobStore(
+            self.redis_client, self.queue.jobs_hash,
+            self.queue.prefix('jobs', ''))
+        assert sparqueue.store.migrate(
+            self.redis_client, self.queue.store, blob) == 1
+        assert blob.load(jobid)['vars']['string'] == 'Hello World'
+        assert not self.redis_client.exists(self.queue.store.job_key(jobid))
+        assert sparqueue.store.migrate(
+            self.redis_client, blob, self.queue.store) == 1
+        assert self.queue.job(jobid)['vars']['string'] == 'Hello World'
+
+    def test_storage_recorded(self):
+        # without storage, the one recorded for the system is used
+        queue = sparqueue.queue.RedisQueue(
+            self.redis_client, self.system_name, 'other')
+        assert queue.store.name == 'hash'
+        assert_raises(
+            sparqueue.queue.QueueException, sparqueue.queue.RedisQueue,
+            self.redis_client, self.system_name, 'other', {'storage': 'blob'})
@@ -0,0 +1,58 @@
+from nose.tools import *
+
+import time
+
+import redis
+import sparqueue.queue
+import sparqueue.reaper
+
+
+class TestReaper:
+
+    def setup(self):
+        self.queue_name = "queueC"
+        self.system_name = "TestC %r" % time.time()
+        self.config = {
+            'lease_timeout': -1,
+            'queues': [{'system': self.system_name, 'queue': self.queue_name}]}
+        self.queue_manager = sparqueue.queue.QueueManager(
+            self.config, self.redis_client)
+        self.queue_manager.add_list(self.config['queues'])
+        self.queue = self.queue_manager.get(self.system_name, self.queue_name)
+
+    @classmethod
+    def setup_class(cls):
+        TestReaper.redis_client = redis.Redis()
+
+    def test_leader(self):
+        key = self.queue.prefix('reaper')
+        first = sparqueue.reaper.Leader(self.redis_client, key, 10)
+        second = sparqueue.reaper.Leader(self.redis_client, key, 10)
+        assert first.acquire()
+        assert first.acquire()
+        assert not second.acquire()
+        assert first.release()
+        assert second.acquire()
+        assert not first.acquire()
+        second.release()
+
+    def test_reap(self):
+        reaper = sparqueue.reaper.Reaper(
+            self.redis_client, self.queue_manager, self.config)
+        other = sparqueue.reaper.Reaper(
+            self.redis_client, self.queue_manager, self.config)
+        jobid = self.queue.push({"class": "dummy", "vars": {}})
+        self.queue_manager.pop(timeout=1)
+        self.redis_client.hset(self.queue.activity_hash, 'stale.1.2.3', 0)
+
+        other.reap()
+        pending = self.redis_client.lrange(self.queue.pending_list, 0, -1)
+        assert pending == [jobid], pending
+        assert not self.redis_client.hexists(
+            self.queue.activity_hash, 'stale.1.2.3')
+
+        self.queue_manager.pop(timeout=1)
+        reaper.reap()
+        # not the leader, nothing requeued
+        assert self.redis_client.llen(self.queue.pending_list) == 0
+        other.release()
@@ -0,0 +1,93 @@
+from nose.tools import *
+
+import logging
+import time
+
+import redis
+import sparqueue.queue
+import sparqueue.reporter
+
+
+class TestReporter:
+
+    def setup(self):
+        self.queue_name = "queueC"
+        self.system_name = "TestC %r" % time.time()
+        self.queue_manager = sparqueue.queue.QueueManager(
+            {}, self.redis_client)
+        self.queue = self.queue_manager.add(self.system_name, self.queue_name)
+        self.jobid = self.queue.push({"class": "dummy", "vars": {}})
+        self.queue_manager.pop(timeout=1)
+        self.logger = logging.getLogger('reporter_tests')
+        # flushed by hand
+        self.flusher = sparqueue.reporter.Flusher(
+            self.redis_client, self.logger)
+
+    @classmethod
+    def setup_class(cls):
+        TestReporter.redis_client = redis.Redis()
+
+    def test_flush_latest(self):
+        reporter = sparqueue.reporter.Reporter(
+            self.logger, self.queue, self.jobid, self.flusher)
+        reporter.step('loading', 4)
+        reporter.increment()
+        assert self.queue.status(self.jobid)['step'] is None
+        reporter.increment()
+        self.flusher.flush()
+        status = self.queue.status(self.jobid)
+        assert status['step'] == 'loading', status
+        assert status['progress'] == 50.0, status
+
+        reporter.progress(75)
+        reporter.finish()
+        assert self.queue.status(self.jobid)['progress'] == 75.0
+        reporter.step('late')
+        self.flusher.flush()
+        assert self.queue.status(self.jobid)['step'] == 'loading'
+
+    def test_without_flusher(self):
+        reporter = sparqueue.reporter.Reporter(
+            self.logger, self.queue, self.jobid)
+        reporter.step('loading', 2)
+        reporter.increment()
+        status = self.queue.status(self.jobid)
+        assert status['step'] == 'loading', status
+        assert status['progress'] == 50.0, status
+        reporter.finish()
+        self.queue.success('done', reporter.stats(), self.jobid)
+        status = self.queue.status(self.jobid)
+        assert status['state'] == 'SUCCESS'
+        assert status['progress'] == 100.0
+
+    def test_step_resources(self):
+        reporter = sparqueue.reporter.Reporter(
+            self.logger, self.queue, self.jobid)
+        reporter.step('spinning')
+        sum(xrange(200000))
+        reporter.step('sleeping')
+        reporter.finish()
+        stats = reporter.stats()
+        assert_equal(['spinning', 'sleeping'], [
+            step['step'] for step in stats['steps']])
+        for step in stats['steps']:
+            assert_equal(
+                set(name for (field, name) in
+                    sparqueue.reporter.RUSAGE_FIELDS),
+                set(step['resources']))
+        assert stats['resources']['cpu_user'] >= 0
+        assert 'profile' not in stats
+
+    def test_profile(self):
+        def perform(count, reporter=None):
+            return sum(xrange(count))
+
+        reporter = sparqueue.reporter.Reporter(
+            self.logger, self.queue, self.jobid)
+        assert_equal(45, reporter.profile(perform, count=10))
+        reporter.finish()
+        profile = reporter.stats()['profile']
+        assert any(
+            function['function'].endswith('(perform)') and
+            function['calls'] == 1 for function in profile), profile
+        assert len(profile) <= sparqueue.reporter.PROFILE_LIMIT
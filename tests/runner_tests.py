@@ -0,0 +1,99 @@
+from nose.tools import *
+
+import os
+import shutil
+import tempfile
+import time
+
+import redis
+import sparqueue.queue
+import sparqueue.runner
+
+JOB = '''
+import %(dependency)s
+
+
+class Job(object):
+    @classmethod
+    def instantiate(cls, config, parameters):
+        return cls()
+
+    def perform(self, reporter, fail=False):
+        reporter.step('performing')
+        if fail:
+            raise ValueError('failed in %%s' %% %(dependency)s.VERSION)
+        return %(dependency)s.VERSION
+'''
+
+
+class TestRunner:
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        suffix = int(time.time() * 1000000)
+        self.module = 'runnerjobs%s' % suffix
+        self.dependency = 'runnerdependency%s' % suffix
+        self.queue_manager = sparqueue.queue.QueueManager(
+            {}, self.redis_client)
+        self.queue = self.queue_manager.add(
+            'TestRunner %r' % time.time(), 'queueR')
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    @classmethod
+    def setup_class(cls):
+        TestRunner.redis_client = redis.Redis()
+
+    def environment(self, version):
+        # the job and the module it imports, in their own directory
+        path = os.path.join(self.directory, 'v%s' % version)
+        os.mkdir(path)
+        for (module, source) in [
+                (self.module, JOB % {'dependency': self.dependency}),
+                (self.dependency, 'VERSION = %r\n' % version)]:
+            f = open(os.path.join(path, '%s.py' % module), 'w')
+            try:
+                f.write(source)
+            finally:
+                f.close()
+        return path
+
+    def job(self, **vars):
+        jobid = self.queue.push({
+            'class': '%s.Job' % self.module, 'vars': vars})
+        (queue, job) = self.queue_manager.pop(timeout=1)
+        assert_equal(jobid, job['metadata']['jobid'])
+        return (queue, job)
+
+    def logs(self):
+        # the process directories under logs
+        if not os.path.isdir('logs'):
+            return []
+        return sorted(os.listdir('logs'))
+
+    def run(self, queue, job, path):
+        return sparqueue.runner.run({}, queue, job, path)
+
+    def test_environments(self):
+        paths = [self.environment(version) for version in [1, 2]]
+        logs = self.logs()
+        for path in paths + paths:
+            (queue, job) = self.job()
+            (output, stats) = self.run(queue, job, path)
+            assert_equal(int(path[-1]), output)
+            assert_equal(['performing'], [
+                step['step'] for step in stats['steps']])
+            assert_equal('performing', self.queue.status(
+                job['metadata']['jobid'])['step'])
+        # reported as the worker, the child process has no log files
+        assert_equal([queue.client_id], self.redis_client.hkeys(
+            self.queue.activity_hash))
+        assert_equal(logs, self.logs())
+
+    def test_failed(self):
+        path = self.environment(1)
+        with assert_raises(sparqueue.runner.RunnerException) as context:
+            (queue, job) = self.job(fail=True)
+            self.run(queue, job, path)
+        assert_equal('ValueError: failed in 1', str(context.exception))
@@ -0,0 +1,149 @@
+from nose.tools import *
+
+import httplib
+import socket
+import threading
+import time
+import wsgiref.simple_server
+import zlib
+
+import sparqueue.client
+import sparqueue.server
+
+
+def slow_app(environ, start_response):
+    time.sleep(0.5)
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['done']
+
+
+def echo_app(environ, start_response):
+    body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH'] or 0))
+    start_response('200 OK', [
+        ('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def stream_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ('x' * 100 for i in xrange(100))
+
+
+class TestThreadPoolServer:
+
+    def start(self, threads, backlog, app=slow_app):
+        server_class = sparqueue.server.server_class(threads, backlog)
+        self.server = server_class(
+            ('127.0.0.1', 0), sparqueue.server.KeepAliveRequestHandler)
+        self.server.set_app(app)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def teardown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, results):
+        conn = httplib.HTTPConnection('127.0.0.1', self.server.server_port)
+        conn.request('GET', '/')
+        resp = conn.getresponse()
+        results.append((resp.status, resp.read()))
+
+    def request_all(self, count):
+        results = []
+        threads = [
+            threading.Thread(target=self.get, args=(results,))
+            for i in xrange(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent(self):
+        self.start(threads=4, backlog=4)
+        start = time.time()
+        results = self.request_all(4)
+        assert time.time() - start < 1.5, time.time() - start
+        assert results == [(200, 'done')] * 4, results
+
+    def test_busy(self):
+        self.start(threads=1, backlog=1)
+        results = self.request_all(4)
+        statuses = sorted(status for (status, content) in results)
+        assert 200 in statuses and 503 in statuses, statuses
+
+    def test_keepalive(self):
+        self.start(threads=1, backlog=1, app=echo_app)
+        conn = httplib.HTTPConnection('127.0.0.1', self.server.server_port)
+        conn.request('POST', '/', 'first')
+        assert conn.getresponse().read() == 'first'
+        sock = conn.sock
+        conn.request('POST', '/', 'second')
+        assert conn.getresponse().read() == 'second'
+        assert conn.sock is sock
+
+
+class TestClient:
+
+    def setup(self):
+        self.posts = []
+        server_class = sparqueue.server.server_class(
+            threads=2, backlog=2, keepalive_timeout=0.2)
+        self.server = server_class(
+            ('127.0.0.1', 0), sparqueue.server.KeepAliveRequestHandler)
+        self.server.set_app(self.app)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.client = sparqueue.client.Client(
+            'http', '127.0.0.1', self.server.server_port, 'system', 'queue',
+            timeout=0.3)
+
+    def teardown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def app(self, environ, start_response):
+        if environ['REQUEST_METHOD'] == 'POST':
+            self.posts.append(environ['PATH_INFO'])
+        if environ['PATH_INFO'] == '/slow':
+            time.sleep(0.6)
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain'), ('Content-Length', '2')])
+        return ['ok']
+
+    def test_stale_resent(self):
+        assert_equal('ok', self.client._request('GET', '/')[1])
+        # the server closes the idle keep-alive connection first
+        time.sleep(0.5)
+        assert_equal('ok', self.client._request('POST', '/', 'job')[1])
+        assert_equal(['/'], self.posts)
+
+    def test_timeout_not_resent(self):
+        assert_equal('ok', self.client._request('GET', '/')[1])
+        assert_raises(
+            socket.timeout, self.client._request, 'POST', '/slow', 'job')
+        time.sleep(0.5)
+        assert_equal(['/slow'], self.posts)
+
+
+class TestGzipMiddleware:
+
+    def call(self, app, encoding='gzip'):
+        started = []
+        environ = {'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': encoding}
+        app = sparqueue.server.GzipMiddleware(app, minimum_size=10)
+        body = ''.join(app(environ, lambda *args: started.extend(args)))
+        return (dict(started[1]), body)
+
+    def test_compressed(self):
+        (headers, body) = self.call(stream_app)
+        assert headers['Content-Encoding'] == 'gzip'
+        assert zlib.decompress(body, 16 + zlib.MAX_WBITS) == 'x' * 10000
+
+    def test_not_accepted(self):
+        (headers, body) = self.call(stream_app, encoding='')
+        assert 'Content-Encoding' not in headers
+        assert body == 'x' * 10000